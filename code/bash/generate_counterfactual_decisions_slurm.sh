@@ -36,91 +36,7 @@ cfn_responses_file=${log_directory}${world_name}/counterfactual_responses:${worl
 python python/utils.py --factual_responses_file=${responses_file} --yn=y --cf_responses_file=${cfy_responses_file}
 python python/utils.py --factual_responses_file=${responses_file} --yn=n --cf_responses_file=${cfn_responses_file}
 
-# run the simulations
-for agent_seed in $(seq 1 $agent_seeds); do
-    echo -ne "Agent seed: $agent_seed/$agent_seeds\r"
-    python python/maze_problem.py --log_file=${log_directory}${world_name}/cfyeslogs:${world_name}_humanscaler:${human_scaler}_aiscaler:${ai_scaler}_simscaler:${sim_scaler}_agentseed:${agent_seed}_semimanualseed:${semi_manual_seed}.json --human_prob_estimates_file=${log_directory}${world_name}/humanprobs:${world_name}_simscaler:${sim_scaler}_semimanualseed:${semi_manual_seed}.json --world_file=$world_file --traffic_delay=$traffic_delay --sim_scaler=$sim_scaler --ai_switching=$ai_switching --human_switching=$human_switching --human_scaler=$human_scaler --ai_scaler=$ai_scaler --radius=$radius --agent_seed=$agent_seed --semi_manual_seed=$semi_manual_seed --override --responses_file=${cfy_responses_file} --horizon=$horizon
-    python python/maze_problem.py --log_file=${log_directory}${world_name}/cfnologs:${world_name}_humanscaler:${human_scaler}_aiscaler:${ai_scaler}_simscaler:${sim_scaler}_agentseed:${agent_seed}_semimanualseed:${semi_manual_seed}.json --human_prob_estimates_file=${log_directory}${world_name}/humanprobs:${world_name}_simscaler:${sim_scaler}_semimanualseed:${semi_manual_seed}.json --world_file=$world_file --traffic_delay=$traffic_delay --sim_scaler=$sim_scaler --ai_switching=$ai_switching --human_switching=$human_switching --human_scaler=$human_scaler --ai_scaler=$ai_scaler --radius=$radius --agent_seed=$agent_seed --semi_manual_seed=$semi_manual_seed --override --responses_file=${cfn_responses_file} --horizon=$horizon
-done
-
-# iterate over the generated json files of the simulations, and get the respective duration needed to reach the goal
-lengths=()
-successes=()
-for file in ${log_directory}${world_name}/cfyeslogs:${world_name}_humanscaler:${human_scaler}_aiscaler:${ai_scaler}*.json; do
-    # find the episode length (in time) and append it to the array
-    length=$(jq '.length' ${file})
-    length=$((length - 1))
-    lengths+=($length)
-    # if length <= t_remaining set success to 1, else set it to 0
-    if [ $length -le $horizon ]; then
-        success=1
-    else
-        success=0
-    fi
-    successes+=($success)
-    # delete the intermediate log files
-    rm ${file}
-done
-
-# compute the mean
-sum=0
-num_elements=${#lengths[@]}
-for i in "${lengths[@]}"; do
-    sum=$((sum + i))
-done
-mean=$(echo "scale=2; $sum / $num_elements" | bc)
-
-# compute the standard deviation
-sum=0
-for i in "${lengths[@]}"; do
-    sum=$(echo "scale=2; $sum + ($i - $mean)^2" | bc)
-done
-std=$(printf "%.2f" $(echo "scale=2; sqrt($sum / $num_elements)" | bc))
-
-# write the mean duration, the standard deviation and the full arrays of durations and successes to a new JSON file (counterfactual report)
-json_array_lengths=$(printf '%d\n' "${lengths[@]}" | jq -s .)
-json_array_successes=$(printf '%d\n' "${successes[@]}" | jq -s .)
-json="{ \"mean_duration\": $mean, \"std\": $std, \"lengths\": $json_array_lengths, \"successes\": $json_array_successes }"
-echo $json > ${log_directory}${world_name}/cfyesreport:${world_name}_humanscaler:${human_scaler}_aiscaler:${ai_scaler}.json;
-
-
-
-# iterate over the generated json files of the simulations, and get the respective duration needed to reach the goal
-lengths=()
-successes=()
-for file in ${log_directory}${world_name}/cfnologs:${world_name}_humanscaler:${human_scaler}_aiscaler:${ai_scaler}*.json; do
-    # find the episode length (in time) and append it to the array
-    length=$(jq '.length' ${file})
-    length=$((length - 1))
-    lengths+=($length)
-    # if length <= t_remaining set success to 1, else set it to 0
-    if [ $length -le $horizon ]; then
-        success=1
-    else
-        success=0
-    fi
-    successes+=($success)
-    # delete the intermediate log files
-    rm ${file}
-done
-
-# compute the mean
-sum=0
-num_elements=${#lengths[@]}
-for i in "${lengths[@]}"; do
-    sum=$((sum + i))
-done
-mean=$(echo "scale=2; $sum / $num_elements" | bc)
-
-# compute the standard deviation
-sum=0
-for i in "${lengths[@]}"; do
-    sum=$(echo "scale=2; $sum + ($i - $mean)^2" | bc)
-done
-std=$(printf "%.2f" $(echo "scale=2; sqrt($sum / $num_elements)" | bc))
-
-# write the mean duration, the standard deviation and the full arrays of durations and successes to a new JSON file (counterfactual report)
-json_array_lengths=$(printf '%d\n' "${lengths[@]}" | jq -s .)
-json_array_successes=$(printf '%d\n' "${successes[@]}" | jq -s .)
-json="{ \"mean_duration\": $mean, \"std\": $std, \"lengths\": $json_array_lengths, \"successes\": $json_array_successes }"
-echo $json > ${log_directory}${world_name}/cfnoreport:${world_name}_humanscaler:${human_scaler}_aiscaler:${ai_scaler}.json;
\ No newline at end of file
+# run the simulations in a single process, and write the mean duration, the standard deviation and the full arrays
+# of durations and successes to a new JSON file (counterfactual report)
+python python/batch_runner.py run --report_file=${log_directory}${world_name}/cfyesreport:${world_name}_humanscaler:${human_scaler}_aiscaler:${ai_scaler}.json --human_prob_estimates_file=${log_directory}${world_name}/humanprobs:${world_name}_simscaler:${sim_scaler}_semimanualseed:${semi_manual_seed}.json --world_file=$world_file --traffic_delay=$traffic_delay --sim_scaler=$sim_scaler --ai_switching=$ai_switching --human_switching=$human_switching --human_scaler=$human_scaler --ai_scaler=$ai_scaler --radius=$radius --agent_seeds=$agent_seeds --semi_manual_seed=$semi_manual_seed --override --responses_file=${cfy_responses_file} --horizon=$horizon
+python python/batch_runner.py run --report_file=${log_directory}${world_name}/cfnoreport:${world_name}_humanscaler:${human_scaler}_aiscaler:${ai_scaler}.json --human_prob_estimates_file=${log_directory}${world_name}/humanprobs:${world_name}_simscaler:${sim_scaler}_semimanualseed:${semi_manual_seed}.json --world_file=$world_file --traffic_delay=$traffic_delay --sim_scaler=$sim_scaler --ai_switching=$ai_switching --human_switching=$human_switching --human_scaler=$human_scaler --ai_scaler=$ai_scaler --radius=$radius --agent_seeds=$agent_seeds --semi_manual_seed=$semi_manual_seed --override --responses_file=${cfn_responses_file} --horizon=$horizon
\ No newline at end of file
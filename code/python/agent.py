@@ -6,12 +6,13 @@ Warning: No pruning - the number of policy trees explodes very fast.
 """
 
 from pomdp_py.framework.basics import Agent
-import numpy as np
-from domain import MazeAction
+from domain import MazeAction, same_maze, LOC_FIELDS
 
 class CompactBelief():
 
-    def __init__(self, maze_map, vehicle_loc, goal_loc, traffic_locs, accident_loc=[-1, -1], closure_loc=[-1, -1], time_idle=0):
+    __slots__ = ('maze_map', 'vehicle_loc', 'goal_loc', 'accident_loc', 'closure_loc', 'traffic_locs', 'time_idle', '_key', '_hash')
+
+    def __init__(self, maze_map, vehicle_loc, goal_loc, traffic_locs, accident_loc=(-1, -1), closure_loc=(-1, -1), time_idle=0):
         
         self.maze_map = maze_map
         self.vehicle_loc = vehicle_loc
@@ -21,14 +22,34 @@ class CompactBelief():
         self.traffic_locs = traffic_locs
         self.time_idle = time_idle
 
+    def __setattr__(self, name, value):
+        # locations are stored as tuples (see MazeState), and any field assignment invalidates the precomputed key and hash
+        if name in LOC_FIELDS:
+            value = LOC_FIELDS[name](value)
+        object.__setattr__(self, name, value)
+        if name not in ('_key', '_hash'):
+            object.__setattr__(self, '_key', None)
+    def _get_key(self):
+        # the time idle and the maze (shared by reference) are left out of the key
+        if self._key is None:
+            self._key = (self.vehicle_loc, self.goal_loc, self.closure_loc, self.accident_loc, self.traffic_locs)
+            self._hash = hash(self._key)
+        return self._key
     def __hash__(self):
-        return hash(str(self).split('_idle')[0])
+        self._get_key()
+        return self._hash
     def __eq__(self, other):
         if isinstance(other, CompactBelief):
-            return str(self) == str(other)
+            return hash(self) == hash(other) and self.time_idle == other.time_idle and self._get_key() == other._get_key()\
+                and same_maze(self.maze_map, other.maze_map)
         return False
+    def __deepcopy__(self, memo):
+        # the maze is never modified and the locations are immutable, so copies share them
+        return CompactBelief(self.maze_map, self.vehicle_loc, self.goal_loc, self.traffic_locs, self.accident_loc, self.closure_loc, self.time_idle)
+    def __reduce__(self):
+        return (CompactBelief, (self.maze_map, self.vehicle_loc, self.goal_loc, self.traffic_locs, self.accident_loc, self.closure_loc, self.time_idle))
     def __str__(self):
-        return "maze_%s_vehicle_%s_goal_%s_closure_%s_accident_%s_traffics_%s_idle_%s" % (np.array2string(self.maze_map), str(self.vehicle_loc),\
+        return "maze_%s_vehicle_%s_goal_%s_closure_%s_accident_%s_traffics_%s_idle_%s" % (str(self.maze_map), str(self.vehicle_loc),\
                                                 str(self.goal_loc), str(self.closure_loc), str(self.accident_loc),\
                                                 str(self.traffic_locs), str(self.time_idle))
     def __repr__(self):
@@ -114,25 +135,15 @@ class LazyAgent(Agent):
     def policy_model(self):
         return self._policy_model
 
-    def _get_candidate_v_loc(self, v_loc, action):
-        if action == 'r':
-            return v_loc[0], v_loc[1]+1
-        elif action == 'l':
-            return v_loc[0], v_loc[1]-1
-        elif action == 'u':
-            return v_loc[0]-1, v_loc[1]
-        elif action == 'd':
-            return v_loc[0]+1, v_loc[1]
-    
     def _get_neighbors(self, node, belief):
-        ACTIONS = ['r', 'l', 'u', 'd']
+        maze_map = belief.maze_map
+        n_cols = maze_map.shape[1]
+        blocked = maze_map.blocked_cells(belief.closure_loc, belief.accident_loc)
         
         adjacent_locs = []
-        for action in ACTIONS:
-            candidate_v_loc = self._get_candidate_v_loc(node, action)
-            is_in_map_boundaries = (0 <= candidate_v_loc[0] < belief.maze_map.shape[0]) and (0 <= candidate_v_loc[1] < belief.maze_map.shape[1])
-            if (is_in_map_boundaries) and (belief.maze_map[candidate_v_loc] == '-') and (list(candidate_v_loc) != belief.closure_loc) and (list(candidate_v_loc) != belief.accident_loc):
-                adjacent_locs.append((action, list(candidate_v_loc)))
+        for action, next_cell in zip(maze_map.ACTIONS, maze_map.next_cell_lists[node[0]*n_cols + node[1]]):
+            if next_cell >= 0 and maze_map.passable_list[next_cell] and next_cell not in blocked:
+                adjacent_locs.append((action, [next_cell // n_cols, next_cell % n_cols]))
 
         return adjacent_locs
     
@@ -0,0 +1,190 @@
+import click
+import copy
+import functools
+import json
+import numpy as np
+import pickle as pkl
+from utils import parse_initial_state
+from domain import MazeState
+from maze_problem import NpEncoder, run_episode, run_prefix, run_fork
+
+@functools.lru_cache(maxsize=None)
+def load_world(world_file, initial_agent):
+    # every world file is parsed once per process, the episodes start from copies of its initial state
+    return MazeState(*parse_initial_state(world_file, initial_agent))
+
+def iter_episodes(world, seeds, params):
+    """
+    Runs one episode per agent seed in a single process and yields their results, in the order of the seeds.
+    world is the world file, params holds the keyword arguments of run_episode, plus the initial agent and,
+    for override episodes, the responses file that is replayed for every seed. The semi-counterfactual episodes
+    (override with a semi_manual_seed) share their factual prefix, which is simulated once and forked for every seed
+    """
+    params = dict(params)
+    initial_agent = params.pop('initial_agent', 'ai')
+    responses_file = params.pop('responses_file', None)
+
+    if params.get('override', False):
+        # there is no keyboard input in a batch, the prompts are answered from the responses file
+        if responses_file is None:
+            raise ValueError('Override episodes need a responses file when they are run in a batch')
+        with open(responses_file, 'rb') as f:
+            given_responses = pkl.load(f)
+        initial_agent = 'ai' if given_responses[0] == 'ai' else 'human'
+        given_responses = given_responses[1:]
+    else:
+        given_responses = None
+
+    init_true_state = load_world(world, initial_agent)
+
+    if given_responses is not None and params.get('semi_manual_seed', None) is not None:
+        # the factual prefix does not depend on the agent seed: it is simulated once, up to the counterfactual prompt,
+        # and the counterfactual continuations of every seed are forked from its snapshot
+        prefix_params = {key: value for key, value in params.items() if key not in ('human_scaler', 'ai_scaler', 'override', 'log_sink')}
+        snapshot, _ = run_prefix(init_true_state=copy.deepcopy(init_true_state), given_responses=list(given_responses), **prefix_params)
+        if snapshot is not None:
+            for agent_seed in seeds:
+                logs = run_fork(snapshot, agent_seed=agent_seed, human_scaler=params.get('human_scaler', None), ai_scaler=params.get('ai_scaler', None), \
+                                verbose=params.get('verbose', 0))
+                result = {'agent_seed': agent_seed, 'initial_agent': initial_agent, 'logs': logs}
+                if snapshot.given_responses:
+                    # what is special about the episode (see execute_episode)
+                    result['explanation'] = snapshot.given_responses[0]
+                yield result
+            return
+
+    for agent_seed in seeds:
+        # the responses are consumed by the episode
+        responses = None if given_responses is None else list(given_responses)
+        logs, _ = run_episode(init_true_state=copy.deepcopy(init_true_state), agent_seed=agent_seed, given_responses=responses, **params)
+        result = {'agent_seed': agent_seed, 'initial_agent': initial_agent, 'logs': logs}
+        if responses:
+            # what is special about the episode (see execute_episode)
+            result['explanation'] = responses.pop(0)
+        yield result
+
+class EpisodeReport:
+    """
+    Aggregates the durations of a batch of episodes as they finish: running mean and variance (Welford's algorithm)
+    and successes, i.e. durations within the time remaining. Only the durations and successes are kept, not the logs.
+    The lengths and successes are listed in the order the episodes are added, i.e. in seed order for report_episodes
+    (the bash loops it replaces listed them in the lexicographic order of the per-seed log files: 1, 10, 100, ..., 2, 20, ...)
+    """
+    def __init__(self, time_remaining):
+        self.time_remaining = time_remaining
+        self.count = 0
+        self.mean = 0.0
+        self.sum_of_squares = 0.0
+        self.lengths = []
+        self.successes = []
+
+    def add(self, logs):
+        # the duration of an episode is its number of transitions
+        length = logs['length'] - 1
+        self.count += 1
+        delta = length - self.mean
+        self.mean += delta / self.count
+        self.sum_of_squares += delta * (length - self.mean)
+        self.lengths.append(length)
+        self.successes.append(int(length <= self.time_remaining))
+
+    @property
+    def std(self):
+        # population standard deviation
+        return float(np.sqrt(self.sum_of_squares / self.count)) if self.count > 0 else 0.0
+
+    def to_dict(self):
+        # the counterfactual report (cfreport, cfyesreport and cfnoreport files)
+        return {'mean_duration': round(self.mean, 2), 'std': round(self.std, 2), 'lengths': self.lengths, 'successes': self.successes}
+
+def run_episodes(world, seeds, params):
+    """
+    Runs one episode per agent seed in a single process and returns their results, in the order of the seeds
+    """
+    return list(iter_episodes(world, seeds, params))
+
+def report_episodes(world, seeds, params, time_remaining=None):
+    """
+    Runs one episode per agent seed in a single process and returns their report,
+    success is judged against time_remaining (by default, the horizon of the episodes)
+    """
+    if time_remaining is None:
+        time_remaining = params.get('horizon', None)
+    if time_remaining is None:
+        raise ValueError('The report needs a time remaining or a horizon to judge the successes')
+    # the report only reads the lengths of the episodes
+    params = dict(params)
+    params.setdefault('log_level', 'none')
+    report = EpisodeReport(time_remaining)
+    for result in iter_episodes(world, seeds, params):
+        report.add(result['logs'])
+    return report
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.option('--output_file', type=str, default=None, help='File where the results of all the episodes are stored')
+@click.option('--report_file', type=str, default=None, help='File where the report (mean and std of the durations, successes) of the episodes is stored, the lengths and successes are listed in seed order')
+@click.option('--time_remaining', type=int, default=None, help='Episodes that last at most this long are successes in the report (default: the horizon)')
+@click.option('--world_file', type=str, required=True, help='World to use')
+@click.option('--agent_seeds', type=int, default=300, help='Number of episodes, one per agent seed')
+@click.option('--first_seed', type=int, default=1, help='Agent seed of the first episode, the following episodes use the next seeds')
+@click.option('--traffic_delay', type=int, default=10, help='Time penalty for crossing a traffic location')
+@click.option('--human_scaler', type=float, default=None, help="Scaler for the human agent's softmax policy")
+@click.option('--ai_scaler', type=float, default=None, help="Scaler for the ai agent's softmax policy")
+@click.option('--ai_switching', type=float, default=0.0, help='Probability of AI suggesting to switch control')
+@click.option('--human_switching', type=float, default=0.0, help='Probability of human suggesting to switch control')
+@click.option('--radius', type=int, default=1, help='The radius of the rectangular field of view')
+@click.option('--verbose', type=click.Choice(['0', '1', '2']), default='0', help='Select level of verbosity')
+@click.option('--sim_scaler', type=float, default=1.0, help="Scaler for the human's simulations")
+@click.option('--initial_agent', type=str, default='ai', help="Initial agent ('ai' or 'human')")
+@click.option('--override', is_flag=True, default=False, help='If true, the switching prompts are answered from the responses file')
+@click.option('--responses_file', type=str, default=None, help='File with the responses to the prompts, replayed in every episode')
+@click.option('--semi_manual_seed', type=int, default=None, help='Seed for the factual part of a semi-counterfactual episode')
+@click.option('--horizon', type=int, default=None, help='Horizon (time limit) of the episode')
+@click.option('--human_prob_estimates_file', type=str, default=None, help='File where the human and ai scores are stored, serves as cache')
+@click.option('--incremental_planning', is_flag=True, default=False, help='If true, replanning after a belief change only repairs the affected cost-to-go values')
+@click.option('--human_simulation_mode', type=click.Choice(['sequential', 'vectorized', 'parallel', 'exact', 'adaptive', 'stratified']), default='sequential', help='How the human simulations behind the switching decisions are run')
+@click.option('--choice_tolerance', type=float, default=0.01, help='The adaptive human simulations stop once the probability of switching is known within this tolerance')
+@click.option('--rao_blackwellize', is_flag=True, default=False, help='If true, the stratified human simulations weight traffic configurations by their prior instead of sampling them (unless there are more configurations than seeds)')
+@click.option('--belief_mode', type=click.Choice(['exact', 'factored']), default='exact', help="How the human's belief is updated from the ai's actions ('factored' keeps per-spot marginals, for worlds with many traffic spots)")
+@click.option('--max_hypotheses', type=int, default=1024, help='In the factored belief mode, beliefs with at most this many traffic hypotheses are still updated exactly')
+@click.option('--num_of_workers', type=int, default=None, help='Number of processes used by the parallel human simulations (default: all cores)')
+@click.option('--log_level', type=click.Choice(['none', 'summary', 'full']), default=None, help="What is logged for every episode (default: 'full' with an output file, otherwise 'none')")
+@click.option('--common_random_numbers', is_flag=True, default=False, help='If true, the random draws are indexed by time step and role, so that batches with different scalers share them seed by seed')
+def run(output_file, report_file, time_remaining, world_file, agent_seeds, first_seed, verbose, **params):
+    """
+    Runs the episodes of agent seeds first_seed, ..., first_seed+agent_seeds-1,
+    stores their results in a single file and/or their report
+    """
+    params['verbose'] = int(verbose)
+    if params['override'] and params['responses_file'] is None:
+        raise click.UsageError('--override needs a --responses_file when the episodes are run in a batch')
+    if output_file is None and report_file is None:
+        raise click.UsageError('Set an --output_file, a --report_file or both')
+    if time_remaining is None:
+        time_remaining = params['horizon']
+    if params['log_level'] is None:
+        params['log_level'] = 'full' if output_file is not None else 'none'
+    if report_file is not None and time_remaining is None:
+        raise click.UsageError('--report_file needs a --time_remaining or a --horizon')
+
+    # the report is aggregated as the episodes finish, the logs are only kept for the output file
+    results = []
+    report = EpisodeReport(time_remaining)
+    for result in iter_episodes(world_file, range(first_seed, first_seed+agent_seeds), params):
+        report.add(result['logs'])
+        if output_file is not None:
+            results.append(result)
+
+    if output_file is not None:
+        with open(output_file, 'w') as f:
+            json.dump(results, f, cls=NpEncoder)
+    if report_file is not None:
+        with open(report_file, 'w') as f:
+            json.dump(report.to_dict(), f)
+
+if __name__ == '__main__':
+    cli()
@@ -1,19 +1,139 @@
 import pomdp_py
 import numpy as np
+import copy
+
+class MazeMap:
+    """
+    Compiled world map, shared by reference between states, beliefs and planners:
+        grid: n*m uint8 array, ROAD (0) or WALL (1)
+        passable: n*m boolean mask of the road tiles
+        cells: n*m array with the flat index of every tile
+        next_cells: (n*m)*4 table with the flat index of the tile reached by each action in ACTIONS, -1 if out of bounds
+        adjacency_indptr, adjacency_indices: CSR adjacency between road tiles, in ACTIONS order
+    Python list versions of the flat tables (passable_list, next_cell_lists, grid_neighbor_lists, neighbor_lists)
+    are kept for the scalar code paths. Closures and accidents are applied on top of these as masks.
+    The map is immutable, copies of it are the map itself.
+    """
+    ROAD = 0
+    WALL = 1
+    ACTIONS = ('r', 'l', 'u', 'd')
+    ACTION_INDEX = {'r': 0, 'l': 1, 'u': 2, 'd': 3}
+
+    __slots__ = ('grid', 'passable', 'cells', 'key', '_hash', 'next_cells', 'adjacency_indptr', 'adjacency_indices', \
+                 'passable_list', 'next_cell_lists', 'grid_neighbor_lists', 'neighbor_lists')
+
+    def __init__(self, grid):
+        self.grid = np.array(grid, dtype=np.uint8)
+        self.grid.setflags(write=False)
+        self.passable = (self.grid == MazeMap.ROAD)
+        self.passable.setflags(write=False)
+        self.cells = np.arange(self.grid.size).reshape(self.grid.shape)
+        self.cells.setflags(write=False)
+        self.key = (self.grid.shape, self.grid.tobytes())
+        self._hash = hash(self.key)
+        self._compile_tables()
+
+    def _compile_tables(self):
+        n_rows, n_cols = self.grid.shape
+        cells = self.cells.ravel()
+        rows, cols = np.divmod(cells, n_cols)
+        next_cells = np.full((cells.size, len(MazeMap.ACTIONS)), -1, dtype=np.int64)
+        next_cells[:, 0] = np.where(cols+1 < n_cols, cells+1, -1)
+        next_cells[:, 1] = np.where(cols-1 >= 0, cells-1, -1)
+        next_cells[:, 2] = np.where(rows-1 >= 0, cells-n_cols, -1)
+        next_cells[:, 3] = np.where(rows+1 < n_rows, cells+n_cols, -1)
+        self.next_cells = next_cells
+        self.next_cells.setflags(write=False)
+
+        # road-to-road adjacency in CSR format
+        passable = self.passable.ravel()
+        adjacent = (next_cells >= 0) & passable[np.maximum(next_cells, 0)] & passable[:, None]
+        self.adjacency_indptr = np.concatenate([[0], np.cumsum(adjacent.sum(axis=1))])
+        self.adjacency_indices = next_cells[adjacent]
+
+        self.passable_list = passable.tolist()
+        self.next_cell_lists = next_cells.tolist()
+        self.grid_neighbor_lists = [[cell for cell in row if cell >= 0] for row in self.next_cell_lists]
+        self.neighbor_lists = [self.adjacency_indices[start:end].tolist() for start, end in zip(self.adjacency_indptr[:-1], self.adjacency_indptr[1:])]
+
+    def blocked_cells(self, *locs):
+        # flat indices of the given locations (e.g. closure and accident), ignoring the unset ones
+        return [self.index(loc) for loc in locs if loc[0] != -1]
+
+    def neighbors_without(self, blocked):
+        # neighbor_lists, with the blocked cells masked out; only the lists of their neighbors are copied
+        if not blocked:
+            return self.neighbor_lists
+        neighbor_lists = list(self.neighbor_lists)
+        for blocked_cell in blocked:
+            for cell in self.neighbor_lists[blocked_cell]:
+                neighbor_lists[cell] = [neighbor for neighbor in neighbor_lists[cell] if neighbor != blocked_cell]
+        return neighbor_lists
+
+    @staticmethod
+    def from_chars(char_map):
+        # '-' tiles are roads, everything else is a wall
+        return MazeMap(np.where(np.asarray(char_map) == '-', MazeMap.ROAD, MazeMap.WALL))
+
+    def to_chars(self):
+        return np.where(self.grid == MazeMap.ROAD, '-', '*').astype('<U1')
+
+    @property
+    def shape(self):
+        return self.grid.shape
+
+    def index(self, loc):
+        return loc[0]*self.grid.shape[1] + loc[1]
+
+    def loc(self, index):
+        return list(divmod(index, self.grid.shape[1]))
+
+    def __hash__(self):
+        return self._hash
+    def __eq__(self, other):
+        if isinstance(other, MazeMap):
+            return self is other or self.key == other.key
+        return False
+    def __copy__(self):
+        return self
+    def __deepcopy__(self, memo):
+        return self
+    def __reduce__(self):
+        return (MazeMap, (self.grid,))
+    def __str__(self):
+        return np.array2string(self.to_chars())
+    def __repr__(self):
+        return "MazeMap: %s" % str(self)
+
+def same_maze(maze_map, other_maze_map):
+    return maze_map is other_maze_map or maze_map == other_maze_map
+
+def as_loc(loc):
+    # locations of states and beliefs are tuples, built once and shared until they are replaced
+    return loc if isinstance(loc, tuple) else tuple(loc)
+
+def as_traffic_locs(traffic_locs):
+    # traffic locations of states and beliefs are tuples of (x, y, value) tuples
+    return traffic_locs if isinstance(traffic_locs, tuple) else tuple(tuple(traffic_loc) for traffic_loc in traffic_locs)
+
+LOC_FIELDS = {'vehicle_loc': as_loc, 'goal_loc': as_loc, 'closure_loc': as_loc, 'accident_loc': as_loc, 'traffic_locs': as_traffic_locs}
 
 class MazeState(pomdp_py.State):
     """
     state space:
-        maze_map: n*n array of roads and obstacles
-        position of vehicle: [int, int]
-        position of goal: [int, int]
-        position of road closure [int, int]
-        position of accident: [int, int]
-        positions of traffic: array of fixed size with elements [int, int, bool]
+        maze_map: MazeMap of roads and obstacles
+        position of vehicle: (int, int)
+        position of goal: (int, int)
+        position of road closure (int, int)
+        position of accident: (int, int)
+        positions of traffic: tuple of fixed size with elements (int, int, bool)
         time the vehicle has been idle: int
         identity of the agent driving: str | 'human' or 'ai'
         committed to action: str | 'l', 'r', 'u', 'd', 'none'
     """
+    __slots__ = ('maze_map', 'vehicle_loc', 'goal_loc', 'closure_loc', 'accident_loc', 'traffic_locs', 'time_idle', 'agent_name', 'committed_action', '_key', '_hash')
+    FIELDS = __slots__[:-2]
+
     def __init__(self, maze_map, vehicle_loc, goal_loc, closure_loc, accident_loc, traffic_locs, time_idle, agent_name='ai', committed_action='none'):
         self.maze_map = maze_map
         self.vehicle_loc = vehicle_loc
@@ -24,14 +144,40 @@ class MazeState(pomdp_py.State):
         self.time_idle = time_idle
         self.agent_name = agent_name
         self.committed_action = committed_action
+    def __setattr__(self, name, value):
+        # locations are stored as tuples, and any field assignment invalidates the precomputed key and hash
+        if name in LOC_FIELDS:
+            value = LOC_FIELDS[name](value)
+        object.__setattr__(self, name, value)
+        if name not in ('_key', '_hash'):
+            object.__setattr__(self, '_key', None)
+    def _get_key(self):
+        # the maze is shared by reference between states and is left out of the key
+        if self._key is None:
+            self._key = (self.vehicle_loc, self.goal_loc, self.closure_loc, self.accident_loc, self.traffic_locs, self.time_idle, self.agent_name, self.committed_action)
+            self._hash = hash(self._key)
+        return self._key
     def __hash__(self):
-        return hash(str(self))
+        self._get_key()
+        return self._hash
     def __eq__(self, other):
         if isinstance(other, MazeState):
-            return str(self) == str(other)
+            return hash(self) == hash(other) and self._get_key() == other._get_key() and same_maze(self.maze_map, other.maze_map)
         return False
+    def __deepcopy__(self, memo):
+        # the maze is never modified and the locations are immutable, so copies share them
+        return self.replace()
+    def replace(self, **changes):
+        # copy-on-write transition: the new state shares the maze and every unchanged field with this one,
+        # so fields of a state must be reassigned rather than modified in place
+        unknown = set(changes) - set(MazeState.FIELDS)
+        if unknown:
+            raise TypeError('MazeState has no field(s) %s' % ', '.join(sorted(unknown)))
+        return MazeState(**{name: changes.get(name, getattr(self, name)) for name in MazeState.FIELDS})
+    def __reduce__(self):
+        return (MazeState, (self.maze_map, self.vehicle_loc, self.goal_loc, self.closure_loc, self.accident_loc, self.traffic_locs, self.time_idle, self.agent_name, self.committed_action))
     def __str__(self):
-        print_map = self.maze_map.copy()
+        print_map = self.maze_map.to_chars()
         print_map[self.vehicle_loc[0], self.vehicle_loc[1]] = 'v'
         print_map[self.goal_loc[0], self.goal_loc[1]] = 'g'
         if self.closure_loc[0] != -1:
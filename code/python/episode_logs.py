@@ -0,0 +1,281 @@
+import json
+import click
+import numpy as np
+
+# Columnar episode logs
+# ---------------------
+# An alternative to the JSON logs of simulate(), written as a single binary file:
+#   - MAGIC, followed by the length of the header (8 bytes, little endian)
+#   - the header, in JSON: the logs without their time steps (map, goal, closure, accident, traffic, length, ...),
+#     the vocabularies of the string columns and the dtype, shape and offset of every column
+#   - the columns, one per time step field, each aligned to ALIGNMENT bytes so that they can be memory-mapped
+# The explored tiles are stored as bit-packed deltas: row t holds the tiles that changed between steps t-1 and t
+# (with an unexplored map before the first step), and the grid of step t is the xor of the rows up to t.
+# The conversion back to the JSON logs is lossless.
+
+class NpEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.integer):
+            return int(obj)
+        if isinstance(obj, np.floating):
+            return float(obj)
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        return super(NpEncoder, self).default(obj)
+
+MAGIC = b'MAZELOG1'
+ALIGNMENT = 64
+COLUMNAR_EXTENSION = '.mazelog'
+STREAMING_EXTENSION = '.jsonl'
+LOG_EXTENSIONS = {'json': '.json', 'columnar': COLUMNAR_EXTENSION, 'jsonl': STREAMING_EXTENSION}
+
+# time step fields stored as codes into a vocabulary
+STRING_FIELDS = ('agent_name', 'action', 'codriver_action', 'committed_action')
+
+def _columns(logs):
+    # the time steps as a dict of arrays, and the vocabularies of the string columns
+    time_steps = logs['time_steps']
+    shape = np.shape(logs['maze_map'])
+    columns = {
+        'time': np.array([step['time'] for step in time_steps], dtype='<i4'),
+        'vehicle_loc': np.array([step['vehicle_loc'] for step in time_steps], dtype='<i4').reshape(-1, 2),
+        'time_idle': np.array([step['time_idle'] for step in time_steps], dtype='<i4'),
+    }
+    vocabularies = {}
+    for field in STRING_FIELDS:
+        values = [step[field] for step in time_steps]
+        vocabularies[field] = sorted(set(values))
+        codes = {value: code for code, value in enumerate(vocabularies[field])}
+        columns[field] = np.array([codes[value] for value in values], dtype=np.uint8)
+
+    # exploration as bit-packed xor deltas between consecutive steps
+    tiles_explored = np.array([step['tiles_explored'] for step in time_steps], dtype=int).reshape(len(time_steps), shape[0]*shape[1])
+    if np.any((tiles_explored != 0) & (tiles_explored != 1)):
+        raise ValueError('The explored tiles are expected to be 0 or 1')
+    tiles_explored = tiles_explored.astype(np.uint8)
+    previous_tiles_explored = np.zeros_like(tiles_explored)
+    previous_tiles_explored[1:] = tiles_explored[:-1]
+    columns['tiles_explored'] = np.packbits(np.bitwise_xor(tiles_explored, previous_tiles_explored), axis=1)
+
+    return columns, vocabularies, shape
+
+def write_columnar_logs(logs, log_file):
+    """
+    Writes the logs of an episode (as filled in by simulate) to a columnar log file
+    """
+    header = {'keys': list(logs.keys()), 'static': {key: value for key, value in logs.items() if key != 'time_steps'}}
+    columns = {}
+    if 'time_steps' in logs:
+        columns, header['vocabularies'], header['shape'] = _columns(logs)
+        header['num_of_steps'] = len(logs['time_steps'])
+
+    # the offsets of the columns are relative to the end of the header
+    header['columns'] = {}
+    offset = 0
+    for name, column in columns.items():
+        header['columns'][name] = {'dtype': column.dtype.str, 'shape': list(column.shape), 'offset': offset}
+        offset += -(-column.nbytes // ALIGNMENT) * ALIGNMENT
+    encoded_header = json.dumps(header, cls=NpEncoder).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(encoded_header)) // ALIGNMENT) * ALIGNMENT
+
+    with open(log_file, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(encoded_header).to_bytes(8, 'little'))
+        f.write(encoded_header)
+        for name, column in columns.items():
+            f.seek(data_start + header['columns'][name]['offset'])
+            f.write(np.ascontiguousarray(column).tobytes())
+        # pad the file so that every column lies within it
+        f.truncate(data_start + offset)
+
+class ColumnarLogs:
+    """
+    Memory-mapped reader of a columnar log file: the columns are only read from disk when accessed
+    """
+    def __init__(self, log_file):
+        self.log_file = log_file
+        with open(log_file, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a columnar log file' % log_file)
+            header_length = int.from_bytes(f.read(8), 'little')
+            self.header = json.loads(f.read(header_length).decode('utf-8'))
+        self.data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+        self.static = self.header['static']
+        self.num_of_steps = self.header.get('num_of_steps', 0)
+        self._columns = {}
+
+    def column(self, name):
+        # raw column (codes for the string fields, packed deltas for the explored tiles)
+        if name not in self._columns:
+            description = self.header['columns'][name]
+            if np.prod(description['shape']) == 0:
+                self._columns[name] = np.zeros(description['shape'], dtype=description['dtype'])
+            else:
+                self._columns[name] = np.memmap(self.log_file, dtype=description['dtype'], mode='r', offset=self.data_start+description['offset'], shape=tuple(description['shape']))
+        return self._columns[name]
+
+    def strings(self, name):
+        # decoded string column
+        vocabulary = np.array(self.header['vocabularies'][name], dtype=object)
+        return vocabulary[np.asarray(self.column(name))]
+
+    def tiles_explored(self, t=None):
+        # grid of explored tiles at step t, or the grids of all the steps (num_of_steps*n*m) if t is None
+        num_of_tiles = int(np.prod(self.header['shape']))
+        packed = self.column('tiles_explored') if t is None else self.column('tiles_explored')[:t+1]
+        deltas = np.unpackbits(packed, axis=1, count=num_of_tiles)
+        grids = np.bitwise_xor.accumulate(deltas, axis=0).reshape(-1, *self.header['shape'])
+        return grids if t is None else grids[-1]
+
+    def to_logs(self):
+        # the logs in the JSON structure written by execute_episode
+        logs = {}
+        for key in self.header['keys']:
+            if key != 'time_steps':
+                logs[key] = self.static[key]
+                continue
+            time = self.column('time').tolist()
+            vehicle_loc = self.column('vehicle_loc').tolist()
+            time_idle = self.column('time_idle').tolist()
+            strings = {field: self.strings(field).tolist() for field in STRING_FIELDS}
+            tiles_explored = self.tiles_explored().astype(int).tolist() if self.num_of_steps > 0 else []
+            logs['time_steps'] = [{
+                'time': time[i],
+                'vehicle_loc': vehicle_loc[i],
+                'time_idle': time_idle[i],
+                'agent_name': strings['agent_name'][i],
+                'action': strings['action'][i],
+                'codriver_action': strings['codriver_action'][i],
+                'tiles_explored': tiles_explored[i],
+                'committed_action': strings['committed_action'][i],
+            } for i in range(self.num_of_steps)]
+        return logs
+
+# Streaming episode logs
+# ----------------------
+# JSON lines written while the episode runs: a header record with the logs known before the first step
+# (map, goal, closure, accident, traffic), one record per time step, and a footer record with the length.
+# The records are buffered and written in chunks, so a crashed episode keeps its header and every flushed step.
+
+class StreamingLogWriter:
+    """
+    Log sink of simulate(): the time steps are written to the log file instead of being kept in the logs
+    """
+    def __init__(self, log_file, flush_every=64):
+        self.log_file = log_file
+        self.flush_every = flush_every
+        self.file = open(log_file, 'w')
+        self.buffer = []
+        self.header_keys = []
+
+    def _write(self, record):
+        self.buffer.append(json.dumps(record, cls=NpEncoder) + '\n')
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.buffer = []
+        self.file.flush()
+
+    def write_header(self, logs):
+        self.header_keys = list(logs.keys())
+        self._write({'header': logs})
+        self.flush()
+
+    def write_step(self, time_step):
+        self._write({'step': time_step})
+
+    def write_footer(self, logs):
+        # the logs that were added after the header
+        self._write({'footer': {key: value for key, value in logs.items() if key not in self.header_keys and key != 'time_steps'}})
+        self.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+def read_streaming_logs(log_file):
+    """
+    Rebuilds the logs of an episode (as filled in by simulate) from a streaming log file. The logs of an
+    unfinished episode have no footer: their length is the number of time steps written and complete is False
+    """
+    with open(log_file, 'r') as f:
+        lines = f.read().splitlines()
+
+    logs = {}
+    time_steps = []
+    footer = None
+    for i, line in enumerate(lines):
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            if i == len(lines)-1:
+                # the last record was cut short by a crash
+                break
+            raise
+        if 'header' in record:
+            logs.update(record['header'])
+        elif 'step' in record:
+            time_steps.append(record['step'])
+        elif 'footer' in record:
+            footer = record['footer']
+    logs['time_steps'] = time_steps
+    if footer is not None:
+        logs.update(footer)
+    else:
+        logs['length'] = len(time_steps)
+        logs['complete'] = False
+
+    return logs
+
+def is_streaming_log_file(log_file):
+    prefix = '{"header": '
+    with open(log_file, 'rb') as f:
+        return f.read(len(prefix)) == prefix.encode('utf-8')
+
+def is_columnar_log_file(log_file):
+    with open(log_file, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def read_logs(log_file):
+    """
+    Reads the logs of an episode from a JSON, columnar or streaming log file
+    """
+    if is_columnar_log_file(log_file):
+        return ColumnarLogs(log_file).to_logs()
+    if is_streaming_log_file(log_file):
+        return read_streaming_logs(log_file)
+    with open(log_file, 'r') as f:
+        return json.load(f)
+
+def write_logs(logs, log_file, log_format='json'):
+    """
+    Writes the logs of an episode in the given format ('json', 'columnar' or 'jsonl')
+    """
+    if log_format == 'columnar':
+        write_columnar_logs(logs, log_file)
+    elif log_format == 'jsonl':
+        keys = list(logs.keys())
+        header_keys = keys[:keys.index('time_steps')] if 'time_steps' in keys else keys
+        log_sink = StreamingLogWriter(log_file)
+        log_sink.write_header({key: logs[key] for key in header_keys})
+        for time_step in logs.get('time_steps', []):
+            log_sink.write_step(time_step)
+        log_sink.write_footer(logs)
+        log_sink.close()
+    else:
+        with open(log_file, 'w') as f:
+            json.dump(logs, f, cls=NpEncoder)
+
+@click.command()
+@click.option('--input_file', type=str, required=True, help='Log file to convert (JSON, columnar or streaming)')
+@click.option('--output_file', type=str, required=True, help='Converted log file')
+@click.option('--log_format', type=click.Choice(['json', 'columnar', 'jsonl']), required=True, help='Format of the converted log file')
+def convert_logs(input_file, output_file, log_format):
+    write_logs(read_logs(input_file), output_file, log_format)
+
+if __name__ == '__main__':
+    convert_logs()
@@ -1,5 +1,5 @@
 import matplotlib.pyplot as plt
-import json
+from episode_logs import read_logs, COLUMNAR_EXTENSION, STREAMING_EXTENSION
 from PIL import Image
 import numpy as np
 from matplotlib.patches import Rectangle, Circle
@@ -297,9 +297,8 @@ def timestep_png(t, maze_map, accident_loc, closure_loc, goal_loc, traffic_locs,
 @click.option('--loop_gif', is_flag=True, help='Whether to loop the GIF file')
 def generate_pngs(log_file, png_directory, icon_directory, loop_gif):
 
-    # read logs from JSON file
-    with open(log_file, 'r') as f:
-        logs = json.load(f)
+    # read logs from the JSON (or columnar, or streaming) log file
+    logs = read_logs(log_file)
 
     maze_map = logs['maze_map']
     accident_loc = logs['accident_loc']
@@ -330,7 +329,10 @@ def generate_pngs(log_file, png_directory, icon_directory, loop_gif):
         return input_string
 
     # read log file parameters and name png directory
-    params = remove_suffix(log_file.split('/')[-1], '.json').split('_')
+    params = log_file.split('/')[-1]
+    for extension in ['.json', COLUMNAR_EXTENSION, STREAMING_EXTENSION]:
+        params = remove_suffix(params, extension)
+    params = params.split('_')
     params = {p.split(':')[0] : p.split(':')[1] for p in params}
     init_agent = params['initagent']
     world_name = params['manuallogs']
@@ -0,0 +1,209 @@
+import click
+import glob
+import os
+import pickle as pkl
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from episode_logs import read_logs, COLUMNAR_EXTENSION, STREAMING_EXTENSION
+from utils import available_cores
+
+# Loader of the episodes directory (resources/episodes/{world}/) for the analysis: every log, report and
+# estimates file becomes a row of a summary table, with the parameters of its filename as columns, and the
+# time steps of the episode logs are gathered in a single steps table. Parsed files are cached by modification time.
+
+LOG_FILE_EXTENSIONS = ('.json', COLUMNAR_EXTENSION, STREAMING_EXTENSION)
+CACHE_VERSION = 1
+# columns of the simulation results
+RESULT_COLUMNS = ['trial', 'tau_scaler', 'theta_scaler', 'prob_succ_no_ai', 'prob_succ_other_decision', 'ai_count', 'human_count', 'prob_other_decision']
+
+def parse_value(value):
+    # filename parameters are numbers when possible
+    for parse in (int, float):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    return value
+
+def parse_filename(log_file):
+    """
+    Parameters encoded in a filename, e.g. cfreport:world43_humanscaler:1.0_aiscaler:1.0.json
+    gives {'kind': 'cfreport', 'world': 'world43', 'humanscaler': 1.0, 'aiscaler': 1.0}
+    """
+    name = os.path.basename(log_file)
+    for extension in LOG_FILE_EXTENSIONS:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            break
+    params = {}
+    for i, param in enumerate(name.split('_')):
+        key, _, value = param.partition(':')
+        if i == 0:
+            params['kind'] = key
+            params['world'] = value
+        else:
+            params[key] = parse_value(value)
+    return params
+
+def load_log_file(log_file):
+    """
+    Parses a single file: the scalar fields (plus the success rate of the reports) as its summary,
+    and the time steps of the episode logs as columns
+    """
+    logs = read_logs(log_file)
+    summary = {key: value for key, value in logs.items() if isinstance(value, (int, float, str, bool))}
+    if 'successes' in logs:
+        summary['num_of_episodes'] = len(logs['successes'])
+        summary['prob_success'] = float(np.mean(logs['successes'])) if len(logs['successes']) > 0 else np.nan
+
+    steps = None
+    if 'time_steps' in logs:
+        time_steps = logs['time_steps']
+        steps = {
+            'time': [step['time'] for step in time_steps],
+            'vehicle_row': [step['vehicle_loc'][0] for step in time_steps],
+            'vehicle_col': [step['vehicle_loc'][1] for step in time_steps],
+            'time_idle': [step['time_idle'] for step in time_steps],
+            'agent_name': [step['agent_name'] for step in time_steps],
+            'action': [step['action'] for step in time_steps],
+            'codriver_action': [step['codriver_action'] for step in time_steps],
+            'committed_action': [step['committed_action'] for step in time_steps],
+            'num_of_tiles_explored': [int(np.sum(step['tiles_explored'])) for step in time_steps],
+        }
+        agent_names = steps['agent_name']
+        summary['num_of_steps'] = len(time_steps)
+        summary['switched'] = any(agent_names[i] != agent_names[i-1] for i in range(1, len(agent_names)))
+
+    return {'summary': summary, 'steps': steps}
+
+def scan_directory(episodes_directory, prefixes=None):
+    # log, report and estimates files of the directory and its subdirectories, optionally only those of some kinds
+    log_files = []
+    for extension in LOG_FILE_EXTENSIONS:
+        log_files += glob.glob(os.path.join(episodes_directory, '**', '*' + extension), recursive=True)
+    if prefixes is not None:
+        log_files = [log_file for log_file in log_files if parse_filename(log_file)['kind'] in prefixes]
+    return sorted(log_files)
+
+def load_directory(episodes_directory, prefixes=None, num_of_workers=None, cache_file=None):
+    """
+    Loads the files of an episodes directory into a summary table (one row per file) and a steps table
+    (one row per time step of the episode logs). Files are parsed in parallel by num_of_workers processes
+    (default: all cores), files unchanged since they were stored in the cache_file (if any) are not parsed again
+    """
+    log_files = scan_directory(episodes_directory, prefixes)
+
+    cache = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            stored_cache = pkl.load(f)
+        if stored_cache.get('version') == CACHE_VERSION:
+            cache = stored_cache['entries']
+
+    # parse the new and modified files
+    stamps = {}
+    for log_file in log_files:
+        stat = os.stat(log_file)
+        stamps[log_file] = (stat.st_mtime_ns, stat.st_size)
+    stale_files = [log_file for log_file in log_files if log_file not in cache or cache[log_file]['stamp'] != stamps[log_file]]
+    if num_of_workers is None:
+        num_of_workers = available_cores()
+    if num_of_workers > 1 and len(stale_files) > 1:
+        with Pool(num_of_workers) as pool:
+            records = pool.map(load_log_file, stale_files, chunksize=max(1, len(stale_files) // (4*num_of_workers)))
+    else:
+        records = [load_log_file(log_file) for log_file in stale_files]
+    for log_file, record in zip(stale_files, records):
+        cache[log_file] = {'stamp': stamps[log_file], 'record': record}
+
+    if cache_file is not None and len(stale_files) > 0:
+        with open(cache_file, 'wb') as f:
+            pkl.dump({'version': CACHE_VERSION, 'entries': cache}, f)
+
+    # assemble the tables
+    summary_rows = []
+    steps_tables = []
+    for log_file in log_files:
+        params = parse_filename(log_file)
+        record = cache[log_file]['record']
+        summary_rows.append({'file': log_file, **params, **record['summary']})
+        if record['steps'] is not None:
+            steps_tables.append(pd.DataFrame({'file': log_file, **params, **record['steps']}))
+    summaries = pd.DataFrame(summary_rows)
+    steps = pd.concat(steps_tables, ignore_index=True) if steps_tables else pd.DataFrame()
+
+    return summaries, steps
+
+def simulation_results(summaries, steps, theta_scalers=(1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0), time_remaining=20, semi_manual_seed=42):
+    """
+    The simulation results of the analysis (code/analysis/files/simulation_results.csv): for every trial, scaler tau
+    of the counterfactual simulations and scaler theta of the switching decision, the probability of success
+    without the ai, with the other switching decision, the probability of the other decision, and the step
+    counts of the ai and the human in the factual episode
+    """
+    # success rates of the reports and estimates of the human, by world and scaler
+    prob_success = {}
+    human_probs = {}
+    for row in summaries.to_dict('records'):
+        if row['kind'] in ('cfreport', 'cfyesreport', 'cfnoreport') and row['humanscaler'] == row['aiscaler']:
+            prob_success[(row['kind'], row['world'], row['humanscaler'])] = row['prob_success']
+        elif row['kind'] == 'humanprobs' and row['semimanualseed'] == semi_manual_seed:
+            human_probs[(row['world'], row['simscaler'])] = (row['ai_score'], row['human_score'])
+    if summaries.empty or not (summaries['kind'] == 'manuallogs').any():
+        # no factual episodes to compare the counterfactual simulations with
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    factual_episodes = summaries[summaries['kind'] == 'manuallogs'].to_dict('records')
+    factual_episodes = sorted(factual_episodes, key=lambda episode: int(episode['explanation'].replace('trial', '')))
+    if steps.empty:
+        # the factual episodes were logged without their time steps
+        steps = pd.DataFrame(columns=['file', 'time', 'agent_name'])
+    steps = steps[steps['time'] <= time_remaining]
+
+    results = []
+    for episode in factual_episodes:
+        world = episode['world']
+        switched = bool(episode['switched'])
+        ai_start = episode['initagent'] == 'ai'
+        # the other decision is not switching if the human switched, and switching otherwise
+        other_report = 'cfnoreport' if switched else 'cfyesreport'
+
+        # step counts of the factual episode, within the time remaining
+        agent_names = steps[steps['file'] == episode['file']]['agent_name']
+        ai_count = int(np.sum(agent_names == 'ai'))
+        human_count = int(np.sum(agent_names == 'human'))
+
+        tau_scalers = sorted(scaler for kind, report_world, scaler in prob_success if kind == 'cfreport' and report_world == world)
+        for theta_scaler in theta_scalers:
+            for tau_scaler in tau_scalers:
+                ai_prob, human_prob = human_probs[(world, tau_scaler)]
+                # the other decision hands the control to the ai if the human switched from the ai or kept driving
+                other_prob = ai_prob if switched == ai_start else human_prob
+                results.append({
+                    'trial': int(episode['explanation'].replace('trial', '')),
+                    'tau_scaler': tau_scaler,
+                    'theta_scaler': theta_scaler,
+                    'prob_succ_no_ai': prob_success[('cfreport', world, tau_scaler)],
+                    'prob_succ_other_decision': prob_success[(other_report, world, tau_scaler)],
+                    'ai_count': ai_count,
+                    'human_count': human_count,
+                    'prob_other_decision': np.exp(theta_scaler*other_prob) / (np.exp(theta_scaler*ai_prob) + np.exp(theta_scaler*human_prob)),
+                })
+
+    return pd.DataFrame(results, columns=RESULT_COLUMNS)
+
+@click.command()
+@click.option('--episodes_directory', type=str, default='./resources/episodes/', help='Directory with the episode logs and reports of every world')
+@click.option('--output_file', type=str, default='./analysis/files/simulation_results.csv', help='File where the simulation results are stored')
+@click.option('--time_remaining', type=int, default=20, help='Time remaining cutoff of the factual step counts')
+@click.option('--num_of_workers', type=int, default=None, help='Number of processes parsing the files (default: all cores)')
+@click.option('--cache_file', type=str, default=None, help='File caching the parsed files (default: log_cache.pkl in the episodes directory)')
+def build_simulation_results(episodes_directory, output_file, time_remaining, num_of_workers, cache_file):
+    if cache_file is None:
+        cache_file = os.path.join(episodes_directory, 'log_cache.pkl')
+    summaries, steps = load_directory(episodes_directory, prefixes=['manuallogs', 'cfreport', 'cfyesreport', 'cfnoreport', 'humanprobs'], \
+                                      num_of_workers=num_of_workers, cache_file=cache_file)
+    simulation_results(summaries, steps, time_remaining=time_remaining).to_csv(output_file, index=False)
+
+if __name__ == '__main__':
+    build_simulation_results()
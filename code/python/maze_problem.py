@@ -1,13 +1,17 @@
 import pomdp_py
 from agent import CompactBelief, LazyAgent
-from utils import parse_initial_state
+from utils import available_cores, parse_initial_state
 from domain import MazeState
 from models import PolicyModel, TransitionModel, ObservationModel, RewardModel
 from itertools import chain, combinations, product
 import copy
-from numpy.random import default_rng
+from numpy.random import default_rng, SeedSequence
+from multiprocessing import Pool
+import os
 import click
-from planner import Planner
+from planner import BucketPlanner, IncrementalPlanner, HypothesesCostsToGo, plan_cache, plan_traffic_states, traffic_key
+from episode_logs import NpEncoder, StreamingLogWriter, write_logs, LOG_EXTENSIONS
+from rollouts import completion_scores, vectorized_human_simulations, exact_human_simulations, adaptive_human_simulations, stratified_human_simulations
 import json
 import numpy as np
 import pickle as pkl
@@ -16,15 +20,15 @@ def powerset(iterable):
     s = list(iterable)
     return chain.from_iterable(combinations(s, r) for r in range(len(s)+1))
 
-class NpEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        if isinstance(obj, np.floating):
-            return float(obj)
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        return super(NpEncoder, self).default(obj)
+# roles of the draws of an episode, with common random numbers
+DRAW_ROLES = {'driver': 0, 'codriver': 1, 'choice': 2, 'simulations': 3}
+
+def common_random_stream(seed, role, *index):
+    # with common random numbers, every draw of an episode comes from a stream of its own, indexed by its role and by the
+    # decision it serves instead of its position in the agent's stream. Episodes with the same seed and different scalers
+    # then share their uniforms decision by decision (actions and switching choices are sampled by inverse cdf), even once
+    # their trajectories diverged or a committed action skipped a draw
+    return default_rng([seed, DRAW_ROLES[role], *index])
 
 class MazeProblem(pomdp_py.POMDP):
     """
@@ -43,6 +47,8 @@ class MazeProblem(pomdp_py.POMDP):
         self.agent_seed = agent_seed
         self.ai_switching = ai_switching
         self.human_switching = human_switching
+        # incremental planners kept between calls to plan(), see get_planner
+        self.planners = {}
 
         self.ai_agent = LazyAgent(ai_init_belief,
                                PolicyModel(ai_scaler, ai_switching),
@@ -100,36 +106,69 @@ class MazeProblem(pomdp_py.POMDP):
 
         return maze_problem
 
-def plan(maze_problem):
+class SimulationSnapshot:
+    """
+    State of simulate() at the start of a time step: the complete maze problem (true state, both beliefs, histories,
+    policies and planners), the costs to go, the logs so far, the remaining responses and the loop variables,
+    along with the settings of the simulation. Continuations of the episode are simulated from forks of the snapshot
+    """
+    def __init__(self, maze_problem, logs, costs_to_go, tiles_explored, t, action, codriver_action, switching_disabled, record_responses, given_responses, num_of_decisions, settings):
+        self.maze_problem = maze_problem
+        self.logs = logs
+        self.costs_to_go = costs_to_go
+        self.tiles_explored = tiles_explored
+        self.t = t
+        self.action = action
+        self.codriver_action = codriver_action
+        self.switching_disabled = switching_disabled
+        self.record_responses = record_responses
+        self.given_responses = given_responses
+        self.num_of_decisions = num_of_decisions
+        self.settings = settings
+
+    def fork(self):
+        # a copy that can be simulated without changing the snapshot, the costs to go are only read by simulate() and are shared
+        return copy.deepcopy(self, memo={id(self.costs_to_go): self.costs_to_go})
+
+def get_planner(maze_problem, planner_name, maze_map, goal_loc, accident_loc, closure_loc, traffic_locs, traffic_delay, agent_name, incremental=False):
+
+    if not incremental:
+        return BucketPlanner(maze_map, goal_loc, accident_loc, closure_loc, traffic_locs, traffic_delay, agent_name)
+
+    # reuse the search state of the previous call, unless the maze or the goal have changed
+    planner = maze_problem.planners.get(planner_name)
+    if planner is None or planner.goal_loc != goal_loc or planner.maze_map != maze_map:
+        planner = IncrementalPlanner(maze_map, goal_loc, accident_loc, closure_loc, traffic_locs, traffic_delay, agent_name)
+        maze_problem.planners[planner_name] = planner
+    else:
+        planner.update(accident_loc, closure_loc, traffic_locs)
+    return planner
+
+def plan_with(planner, incremental=False):
+    # incremental planners bypass the plan cache: a cache hit would skip their repair, which would then pile up until the next miss
+    return planner.dijkstra() if incremental else plan_cache.plan(planner)
+
+def plan(maze_problem, incremental=False):
     
     costs_to_go = {'ai': {}, 'human': {}}
     
     # ai planning
-    planner = Planner(maze_problem.ai_agent.belief.maze_map, maze_problem.ai_agent.belief.goal_loc, maze_problem.ai_agent.belief.accident_loc, maze_problem.ai_agent.belief.closure_loc, \
-                maze_problem.ai_agent.belief.traffic_locs, maze_problem.env.transition_model.traffic_delay, agent_name='ai') 
-    costs_to_go['ai'][str(maze_problem.ai_agent.belief.traffic_locs)] = planner.dijkstra()
+    planner = get_planner(maze_problem, 'ai', maze_problem.ai_agent.belief.maze_map, maze_problem.ai_agent.belief.goal_loc, maze_problem.ai_agent.belief.accident_loc, maze_problem.ai_agent.belief.closure_loc, \
+                maze_problem.ai_agent.belief.traffic_locs, maze_problem.env.transition_model.traffic_delay, agent_name='ai', incremental=incremental)
+    costs_to_go['ai'][traffic_key(maze_problem.ai_agent.belief.traffic_locs)] = plan_with(planner, incremental)
     
     # plan according to human belief
-    # generate all combinations of human_agent.belief.traffic_locs where the third element of each element is set to 0 or 1
-    unknown_traffic_locs = [(ind, loc) for ind, loc in enumerate(maze_problem.human_agent.belief.traffic_locs) if loc[2] not in {0.0, 1.0}]
-    unknown_traffic_loc_states = list(product([0.0, 1.0], repeat=len(unknown_traffic_locs)))
-    
-    # ai planning, simulated by the human
-    traffic_locs = copy.deepcopy(maze_problem.human_agent.belief.traffic_locs)
+    # ai planning, simulated by the human: every combination of human_agent.belief.traffic_locs where the third element of each
+    # uncertain traffic location is set to 0 or 1 is planned lazily, the first time it is accessed
     closure_loc = maze_problem.ai_agent.belief.closure_loc # NOTE: the human assumes that the ai doesn't have additional information about the closure location, other than what it has directly observed
-    for unknown_traffic_loc_state in unknown_traffic_loc_states:
-        for ind, loc in enumerate(unknown_traffic_locs):
-            traffic_locs[loc[0]][2] = unknown_traffic_loc_state[ind]
-        
-        planner = Planner(maze_problem.human_agent.belief.maze_map, maze_problem.human_agent.belief.goal_loc, maze_problem.human_agent.belief.accident_loc, closure_loc, traffic_locs, \
-                    maze_problem.env.transition_model.traffic_delay, agent_name='ai')
-        costs_to_go['human'][str(traffic_locs)] = planner.dijkstra()
+    costs_to_go['human'] = HypothesesCostsToGo(maze_problem.human_agent.belief.maze_map, maze_problem.human_agent.belief.goal_loc, maze_problem.human_agent.belief.accident_loc, closure_loc, \
+                    maze_problem.human_agent.belief.traffic_locs, maze_problem.env.transition_model.traffic_delay)
 
     # human planning
     traffic_locs = copy.deepcopy(maze_problem.human_agent.belief.traffic_locs)
-    planner = Planner(maze_problem.human_agent.belief.maze_map, maze_problem.human_agent.belief.goal_loc, maze_problem.human_agent.belief.accident_loc, maze_problem.human_agent.belief.closure_loc, \
-                    traffic_locs, maze_problem.env.transition_model.traffic_delay, agent_name='human')
-    costs_to_go['human'][str(maze_problem.human_agent.belief.traffic_locs)] = planner.dijkstra()
+    planner = get_planner(maze_problem, 'human', maze_problem.human_agent.belief.maze_map, maze_problem.human_agent.belief.goal_loc, maze_problem.human_agent.belief.accident_loc, maze_problem.human_agent.belief.closure_loc, \
+                    traffic_locs, maze_problem.env.transition_model.traffic_delay, agent_name='human', incremental=incremental)
+    costs_to_go['human'][traffic_key(maze_problem.human_agent.belief.traffic_locs)] = plan_with(planner, incremental)
 
     return costs_to_go
 
@@ -157,109 +196,181 @@ def update_explored_tiles(maze_problem, tiles_explored, state):
         if is_in_map_boundaries:
             tiles_explored[loc[0]][loc[1]] = 1
 
-def update_logs(logs, maze_problem, action, codriver_action, tiles_explored, t):
+def update_logs(logs, maze_problem, action, codriver_action, tiles_explored, t, log_level='full', log_sink=None):
     
-    logs['time_steps'].append({
+    if log_level == 'none':
+        return
+    if log_level == 'summary':
+        # only the aggregates of the time steps are kept
+        logs['num_of_%s_steps' % maze_problem.env.state.agent_name] += 1
+        logs['num_of_idle_steps'] += int(maze_problem.env.state.time_idle > 0)
+        return
+
+    time_step = {
             'time' : t,
-            'vehicle_loc' : copy.deepcopy(maze_problem.env.state.vehicle_loc),
+            'vehicle_loc' : list(maze_problem.env.state.vehicle_loc),
             'time_idle' : copy.deepcopy(maze_problem.env.state.time_idle),
             'agent_name' : copy.deepcopy(maze_problem.env.state.agent_name),
             'action' : copy.deepcopy(action.dir),
             'codriver_action' : copy.deepcopy(codriver_action.dir),
             'tiles_explored' : copy.deepcopy(tiles_explored),
             'committed_action' : copy.deepcopy(maze_problem.env.state.committed_action),
-        })
+        }
+    if log_sink is not None:
+        # streamed to the log file instead of kept in memory
+        log_sink.write_step(time_step)
+    else:
+        logs['time_steps'].append(time_step)
 
 def update_beliefs(maze_problem, ai_observation, human_observation):
     
     # update the AI agent's belief
     new_ai_belief = CompactBelief(maze_problem.env.state.maze_map, maze_problem.env.state.vehicle_loc, maze_problem.env.state.goal_loc,\
-                                copy.deepcopy(maze_problem.ai_agent.belief.traffic_locs), maze_problem.ai_agent.belief.accident_loc,\
+                                maze_problem.ai_agent.belief.traffic_locs, maze_problem.ai_agent.belief.accident_loc,\
                                 maze_problem.ai_agent.belief.closure_loc, maze_problem.env.state.time_idle)
-    if ai_observation.accident_loc != [-1, -1]:
+    if ai_observation.accident_loc[0] != -1:
         new_ai_belief.accident_loc = ai_observation.accident_loc
-    if ai_observation.closure_loc != [-1, -1]:
+    if ai_observation.closure_loc[0] != -1:
         new_ai_belief.closure_loc = ai_observation.closure_loc
 
     # update the human agent's belief
     new_human_belief = CompactBelief(maze_problem.env.state.maze_map, maze_problem.env.state.vehicle_loc, maze_problem.env.state.goal_loc,\
-                                copy.deepcopy(maze_problem.human_agent.belief.traffic_locs), maze_problem.human_agent.belief.accident_loc,\
+                                maze_problem.human_agent.belief.traffic_locs, maze_problem.human_agent.belief.accident_loc,\
                                 maze_problem.human_agent.belief.closure_loc, maze_problem.env.state.time_idle)
     
-    if human_observation.accident_loc != [-1, -1]:
+    if human_observation.accident_loc[0] != -1:
         new_human_belief.accident_loc = human_observation.accident_loc
-    for i, traffic_loc in enumerate(human_observation.traffic_locs):
-        if traffic_loc[2] != -1:
-            new_human_belief.traffic_locs[i][2] = float(traffic_loc[2])
+    # the observed traffic spots replace the human's belief about them
+    new_human_belief.traffic_locs = [(belief_loc[0], belief_loc[1], float(traffic_loc[2])) if traffic_loc[2] != -1 else belief_loc \
+                                     for belief_loc, traffic_loc in zip(new_human_belief.traffic_locs, human_observation.traffic_locs)]
 
     return new_ai_belief, new_human_belief
     
 def bayesian_update(maze_problem, new_human_belief, costs_to_go, action):
     
     temp_belief = copy.deepcopy(new_human_belief)
+    traffic_locs = temp_belief.traffic_locs
     # find the traffic locations whose condition is uncertain
-    unknown_traffic_locs = [(ind, loc) for ind, loc in enumerate(temp_belief.traffic_locs) if loc[2] not in {0.0, 1.0}]
-    unknown_traffic_loc_states = list(product([0.0, 1.0], repeat=len(unknown_traffic_locs)))
-    
-    # for each possible state of the uncertain traffic locations, compute the posterior probability
-    posteriors = []
-    for unknown_traffic_loc_state in unknown_traffic_loc_states:
-        
-        # potential_traffic_locs is one possible state of the uncertain traffic locations
-        potential_traffic_locs = copy.deepcopy(temp_belief.traffic_locs)
-        for ind, loc in enumerate(unknown_traffic_locs):
-            potential_traffic_locs[loc[0]][2] = unknown_traffic_loc_state[ind]
-
-        # compute the prior probability of that particular state
-        prior = 1
-        for ind, x in enumerate(temp_belief.traffic_locs):
-            # prior is the probability of potential_traffic_locs according to the human's belief
-            prior *= potential_traffic_locs[ind][2]*x[2] + (1-potential_traffic_locs[ind][2])*(1-x[2])
-
-        # compute the likelihood of the ai's action given the potential_traffic_locs
-        potential_belief = copy.deepcopy(maze_problem.human_agent.belief)
-        potential_belief.traffic_locs = potential_traffic_locs  # assumes the ai is planning given that particular state of traffic
-        potential_belief.closure_loc = maze_problem.ai_agent.belief.closure_loc # NOTE: assumes the ai is planning without additional knowledge about the road closure
-        action_logits = maze_problem.human_agent.get_action_logits(costs_to_go['human'][str(potential_traffic_locs)], potential_belief)
-        likelihood = maze_problem.human_agent.policy_model.probability(action, action_logits, sim_scaler=maze_problem.sim_scaler)
-
-        # baye's rule
-        posteriors.append((likelihood * prior, potential_traffic_locs))
-
-    # normalize the posteriors
-    for i in range(len(temp_belief.traffic_locs)):
-        post = 0
-        temp_belief.traffic_locs[i][2] = 0
-        for j in range(len(posteriors)):
-            if posteriors[j][1][i][2] == 1:
-                temp_belief.traffic_locs[i][2] += posteriors[j][0]
-            post += posteriors[j][0]
-        temp_belief.traffic_locs[i][2] /= post
-        
-        # NOTE: round the probabilities to 5 decimal places -- this is to avoid numerical errors when accessing costs_to_go['human']
-        temp_belief.traffic_locs[i][2] = round(temp_belief.traffic_locs[i][2], 5)
+    unknown_inds = [ind for ind, loc in enumerate(traffic_locs) if loc[2] not in {0.0, 1.0}]
+    # each row is one possible state of the traffic locations, in the order of product([0.0, 1.0], ...)
+    hypotheses = np.tile(np.array([loc[2] for loc in traffic_locs], dtype=float), (2**len(unknown_inds), 1))
+    hypotheses[:, unknown_inds] = np.array(list(product([0.0, 1.0], repeat=len(unknown_inds))), ndmin=2)
+
+    # prior probability of every state according to the human's belief
+    priors = np.ones(len(hypotheses))
+    for ind in unknown_inds:
+        priors *= np.where(hypotheses[:, ind] == 1.0, traffic_locs[ind][2], 1-traffic_locs[ind][2])
+
+    # likelihood of the ai's action given every state, from the stacked cost-to-go fields of the hypotheses
+    # NOTE: assumes the ai is planning without additional knowledge about the road closure
+    potential_belief = copy.deepcopy(maze_problem.human_agent.belief)
+    potential_belief.closure_loc = maze_problem.ai_agent.belief.closure_loc
+    neighbors = maze_problem.human_agent._get_neighbors(potential_belief.vehicle_loc, potential_belief)
+    neighbor_cells = [potential_belief.maze_map.index(loc) for _, loc in neighbors]
+    action_ind = [direction for direction, _ in neighbors].index(action.dir[0])
+    neighbor_costs = costs_to_go['human'].stack()[:, neighbor_cells]
+    scaler = maze_problem.sim_scaler if maze_problem.sim_scaler is not None else maze_problem.human_agent.policy_model.scaler
+    if scaler is not None:
+        # softmax score of the action (see PolicyModel.probability)
+        logits = -scaler*neighbor_costs
+        likelihoods = (np.exp(logits) / np.sum(np.exp(logits), axis=1, keepdims=True))[:, action_ind]
+    else:
+        likelihoods = (np.argmin(neighbor_costs, axis=1) == action_ind).astype(float)
+
+    # baye's rule, and marginal probability of traffic at every location
+    # NOTE: cumsum adds the posteriors in order, as the original loop did
+    posteriors = likelihoods * priors
+    post = np.cumsum(posteriors)[-1]
+    marginals = np.cumsum(np.where(hypotheses == 1, posteriors[:, None], 0.0), axis=0)[-1]
+
+    # NOTE: round the probabilities to 5 decimal places -- this is to avoid numerical errors when accessing costs_to_go['human']
+    temp_belief.traffic_locs = [[loc[0], loc[1], round(marginals[i] / post, 5)] for i, loc in enumerate(traffic_locs)]
         
     return temp_belief
 
-def initialize_logs(maze_problem, logs):
+def factored_bayesian_update(maze_problem, new_human_belief, costs_to_go, action, max_hypotheses=1024):
+
+    # find the traffic locations whose condition is uncertain
+    unknown_inds = [ind for ind, loc in enumerate(new_human_belief.traffic_locs) if loc[2] not in {0.0, 1.0}]
+    if not unknown_inds or 2**len(unknown_inds) <= max_hypotheses:
+        # few enough hypotheses, the exact update is affordable
+        return bayesian_update(maze_problem, new_human_belief, costs_to_go, action)
+
+    # mean-field approximation: the belief is kept as independent per-spot marginals, and the evidence for each spot
+    # is the likelihood of the ai's action when that spot is set to 0.0 or 1.0 and the others to their marginals
+    # (i.e. planning with expected costs, as the human does), which takes 2 plans per uncertain spot
+    temp_belief = copy.deepcopy(new_human_belief)
+    marginals = np.array([temp_belief.traffic_locs[ind][2] for ind in unknown_inds], dtype=float)
+    traffic_states = np.repeat(marginals[None, :], 2*len(unknown_inds), axis=0)
+    for col in range(len(unknown_inds)):
+        traffic_states[2*col, col] = 0.0
+        traffic_states[2*col+1, col] = 1.0
+
+    # NOTE: assumes the ai is planning without additional knowledge about the road closure (as in bayesian_update)
+    potential_belief = copy.deepcopy(maze_problem.human_agent.belief)
+    potential_belief.closure_loc = maze_problem.ai_agent.belief.closure_loc
+    fields = plan_traffic_states(potential_belief.maze_map, potential_belief.goal_loc, potential_belief.accident_loc, potential_belief.closure_loc, \
+                                 potential_belief.traffic_locs, maze_problem.traffic_delay, unknown_inds, traffic_states)
+    neighbors = maze_problem.human_agent._get_neighbors(potential_belief.vehicle_loc, potential_belief)
+    neighbor_cells = [potential_belief.maze_map.index(loc) for _, loc in neighbors]
+    action_ind = [direction for direction, _ in neighbors].index(action.dir[0])
+    neighbor_costs = fields[:, neighbor_cells]
+    scaler = maze_problem.sim_scaler if maze_problem.sim_scaler is not None else maze_problem.human_agent.policy_model.scaler
+    if scaler is not None:
+        logits = -scaler*neighbor_costs
+        likelihoods = (np.exp(logits) / np.sum(np.exp(logits), axis=1, keepdims=True))[:, action_ind]
+    else:
+        likelihoods = (np.argmin(neighbor_costs, axis=1) == action_ind).astype(float)
+    likelihoods = likelihoods.reshape(len(unknown_inds), 2)
+
+    # baye's rule for every spot
+    posteriors = marginals * likelihoods[:, 1] / (marginals * likelihoods[:, 1] + (1-marginals) * likelihoods[:, 0])
+    traffic_locs = [list(traffic_loc) for traffic_loc in temp_belief.traffic_locs]
+    for col, ind in enumerate(unknown_inds):
+        # NOTE: round the probabilities to 5 decimal places -- this is to avoid numerical errors when accessing costs_to_go['human']
+        traffic_locs[ind][2] = round(posteriors[col], 5)
+    temp_belief.traffic_locs = traffic_locs
 
-    maze_map = copy.deepcopy(maze_problem.env.state.maze_map)
-    maze_map[maze_map == '*'] = 1
-    maze_map[maze_map == '-'] = 0
-    maze_map = maze_map.astype(int).tolist()
-    goal_loc = copy.deepcopy(maze_problem.env.state.goal_loc)
-    closure_loc = copy.deepcopy(maze_problem.env.state.closure_loc)
-    accident_loc = copy.deepcopy(maze_problem.env.state.accident_loc)
-    traffic_locs = copy.deepcopy(maze_problem.env.state.traffic_locs)
+    return temp_belief
+
+def initialize_logs(maze_problem, logs, log_level='full'):
+    # log levels: 'full' logs the map and every time step, 'summary' only the length, success and aggregates
+    # of the episode, 'none' only the length and success (e.g., for the human simulations)
+
+    if log_level == 'none':
+        return
+    if log_level == 'summary':
+        logs['num_of_ai_steps'] = 0
+        logs['num_of_human_steps'] = 0
+        logs['num_of_idle_steps'] = 0
+        return
+
+    # the locations are logged as lists
+    maze_map = maze_problem.env.state.maze_map.grid.tolist()
+    goal_loc = list(maze_problem.env.state.goal_loc)
+    closure_loc = list(maze_problem.env.state.closure_loc)
+    accident_loc = list(maze_problem.env.state.accident_loc)
+    traffic_locs = [list(traffic_loc) for traffic_loc in maze_problem.env.state.traffic_locs]
     logs['maze_map'] = maze_map
     logs['goal_loc'] = goal_loc
     logs['closure_loc'] = closure_loc
     logs['accident_loc'] = accident_loc
     logs['traffic_locs'] = traffic_locs
+
+def finalize_logs(logs, tiles_explored, length, goal_reached, horizon=None, log_level='full', log_sink=None):
+
+    logs['length'] = length
+    if log_level != 'full':
+        # the episode succeeds if the goal is reached within the horizon (if any)
+        logs['success'] = goal_reached and (horizon is None or length-1 <= horizon)
+    if log_level == 'summary':
+        logs['num_of_tiles_explored'] = int(np.sum(tiles_explored))
+    if log_sink is not None:
+        log_sink.write_footer(logs)
     
-def human_simulations(maze_problem, rng_agent, num_of_seeds=10, time_remaining=None):
+def human_simulations(maze_problem, rng_agent, num_of_seeds=10, time_remaining=None, common_random_numbers=False, belief_mode='exact', max_hypotheses=1024):
 
-    simulated_state = copy.deepcopy(maze_problem.env.state)
+    simulated_state = maze_problem.env.state.replace()
 
     # simulate future of the episode with human in control
     # details of the simulation:
@@ -273,20 +384,24 @@ def human_simulations(maze_problem, rng_agent, num_of_seeds=10, time_remaining=N
     simulated_state.accident_loc = maze_problem.human_agent.belief.accident_loc # inside the simulation, the true state matches the human's belief
     simulated_state.closure_loc = maze_problem.human_agent.belief.closure_loc
 
+    if common_random_numbers:
+        # the human and ai simulations of every seed share their traffic conditions, and their uniforms
+        traffic_uniforms = rng_agent.random((num_of_seeds, len(maze_problem.human_agent.belief.traffic_locs)))
+    def sample_traffic(seed):
+        if common_random_numbers:
+            return [[traffic_x, traffic_y, int(uniform < traffic_prob)] for (traffic_x, traffic_y, traffic_prob), uniform in zip(maze_problem.human_agent.belief.traffic_locs, traffic_uniforms[seed])]
+        return [[traffic_x, traffic_y, rng_agent.binomial(1, traffic_prob)] for traffic_x, traffic_y, traffic_prob in maze_problem.human_agent.belief.traffic_locs]
+
     human_completion_times = []
     for seed in range(num_of_seeds):
         # for every simulation, the true traffic conditions are sampled from bernoullis based on the human's belief
-        simulated_state.traffic_locs = [[traffic_x, traffic_y, rng_agent.binomial(1, traffic_prob)] for traffic_x, traffic_y, traffic_prob in maze_problem.human_agent.belief.traffic_locs]
+        simulated_state.traffic_locs = sample_traffic(seed)
         simulated_human_problem = MazeProblem.create(init_true_state=simulated_state, traffic_delay=maze_problem.traffic_delay, radius=maze_problem.radius, human_scaler=maze_problem.sim_scaler, \
                                             ai_scaler=maze_problem.sim_scaler, agent_seed=seed, ai_switching=0.0, human_switching=0.0, human_simulation_belief=maze_problem.human_agent.belief)
         human_logs = {}
-        _ = simulate(simulated_human_problem, human_logs, verbose=0)
+        _ = simulate(simulated_human_problem, human_logs, verbose=0, log_level='none', common_random_numbers=common_random_numbers, belief_mode=belief_mode, max_hypotheses=max_hypotheses)
         human_completion_times.append(human_logs['length']-1)
 
-    # NOTE: adding +1 to the average completion time if the driver changes
-    # because the simulated episodes start one time step later
-    if maze_problem.env.state.agent_name == 'ai':
-        human_completion_times = [t+1 for t in human_completion_times]
 
     # simulate future of the episode with ai in control
     # details of the simulation:
@@ -304,7 +419,7 @@ def human_simulations(maze_problem, rng_agent, num_of_seeds=10, time_remaining=N
     ai_completion_times = []
     for seed in range(num_of_seeds):
         # for every simulation, the true traffic conditions are sampled from bernoullis based on the human's belief
-        simulated_state.traffic_locs = [[traffic_x, traffic_y, rng_agent.binomial(1, traffic_prob)] for traffic_x, traffic_y, traffic_prob in maze_problem.human_agent.belief.traffic_locs]
+        simulated_state.traffic_locs = sample_traffic(seed)
         ai_simulated_belief=copy.deepcopy(maze_problem.ai_agent.belief)
         # the planning is done using the sampled traffic conditions
         ai_simulated_belief.traffic_locs = copy.deepcopy(simulated_state.traffic_locs)
@@ -312,41 +427,147 @@ def human_simulations(maze_problem, rng_agent, num_of_seeds=10, time_remaining=N
         simulated_human_problem = MazeProblem.create(init_true_state=simulated_state, traffic_delay=maze_problem.traffic_delay, radius=maze_problem.radius, human_scaler=maze_problem.sim_scaler, \
                                         ai_scaler=maze_problem.sim_scaler, agent_seed=seed, ai_switching=0.0, human_switching=0.0, ai_simulation_belief=ai_simulated_belief)
         ai_logs = {}
-        _ = simulate(simulated_human_problem, ai_logs, verbose=0)
+        _ = simulate(simulated_human_problem, ai_logs, verbose=0, log_level='none', common_random_numbers=common_random_numbers, belief_mode=belief_mode, max_hypotheses=max_hypotheses)
         ai_completion_times.append(ai_logs['length']-1)
 
-    # NOTE: adding +1 to the average completion time if the driver changes
-    # because the simulated episodes start one time step later
-    if maze_problem.env.state.agent_name == 'human':
-        ai_completion_times = [t+1 for t in ai_completion_times]
-
-    if time_remaining is None:
-        # set AI and human scores as the negative average completion times
-        ai_score = - np.mean(ai_completion_times)
-        human_score = - np.mean(human_completion_times)
+    return completion_scores(maze_problem, ai_completion_times, human_completion_times, time_remaining)
+
+def simulate_rollout(args):
+    # single rollout of human_simulations with its own random streams, run by the workers of parallel_human_simulations
+    simulated_state, human_belief, ai_belief, traffic_delay, radius, sim_scaler, belief_mode, max_hypotheses, seed_sequence = args
+    traffic_seed, agent_seed = seed_sequence.spawn(2)
+    rng_traffic = default_rng(traffic_seed)
+    # the true traffic conditions are sampled from bernoullis based on the human's belief
+    simulated_state = simulated_state.replace(traffic_locs=[[traffic_x, traffic_y, rng_traffic.binomial(1, traffic_prob)] for traffic_x, traffic_y, traffic_prob in human_belief.traffic_locs])
+    if simulated_state.agent_name == 'human':
+        simulated_problem = MazeProblem.create(init_true_state=simulated_state, traffic_delay=traffic_delay, radius=radius, human_scaler=sim_scaler, \
+                                            ai_scaler=sim_scaler, agent_seed=agent_seed, ai_switching=0.0, human_switching=0.0, human_simulation_belief=human_belief)
     else:
-        # set AI and human scores as the probability of reaching the goal within the horizon
-        ai_score = np.mean(np.array(ai_completion_times) <= time_remaining)
-        human_score = np.mean(np.array(human_completion_times) <= time_remaining)
-
-    return ai_score, human_score
+        ai_simulated_belief = copy.deepcopy(ai_belief)
+        # the planning is done using the sampled traffic conditions
+        ai_simulated_belief.traffic_locs = copy.deepcopy(simulated_state.traffic_locs)
+        simulated_problem = MazeProblem.create(init_true_state=simulated_state, traffic_delay=traffic_delay, radius=radius, human_scaler=sim_scaler, \
+                                            ai_scaler=sim_scaler, agent_seed=agent_seed, ai_switching=0.0, human_switching=0.0, ai_simulation_belief=ai_simulated_belief)
+    logs = {}
+    _ = simulate(simulated_problem, logs, verbose=0, log_level='none', belief_mode=belief_mode, max_hypotheses=max_hypotheses)
+    return logs['length']-1
+
+def parallel_human_simulations(maze_problem, rng_agent, num_of_seeds=10, time_remaining=None, num_of_workers=None, belief_mode='exact', max_hypotheses=1024):
+
+    # same simulations as human_simulations, spread over a pool of processes
+    # every rollout gets an independent random stream spawned from a SeedSequence seeded by rng_agent,
+    # so the scores only depend on the seed and not on the number of workers
+    seed_sequences = SeedSequence(rng_agent.integers(2**63)).spawn(2*num_of_seeds)
+    human_belief = maze_problem.human_agent.belief
+    ai_belief = maze_problem.ai_agent.belief
+    # accident and closure locations (if any) match the human's belief, not the true state
+    human_state = maze_problem.env.state.replace(agent_name='human', committed_action='none', accident_loc=human_belief.accident_loc, closure_loc=human_belief.closure_loc)
+    ai_state = maze_problem.env.state.replace(agent_name='ai', accident_loc=human_belief.accident_loc, closure_loc=human_belief.closure_loc)
+    tasks = [(human_state if i < num_of_seeds else ai_state, human_belief, ai_belief, maze_problem.traffic_delay, maze_problem.radius, maze_problem.sim_scaler, \
+              belief_mode, max_hypotheses, seed_sequence) \
+             for i, seed_sequence in enumerate(seed_sequences)]
+
+    if num_of_workers is None:
+        num_of_workers = available_cores()
+    if num_of_workers > 1:
+        with Pool(num_of_workers) as pool:
+            completion_times = pool.map(simulate_rollout, tasks, chunksize=max(1, len(tasks) // (4*num_of_workers)))
+    else:
+        completion_times = [simulate_rollout(task) for task in tasks]
+
+    return completion_scores(maze_problem, completion_times[num_of_seeds:], completion_times[:num_of_seeds], time_remaining)
+
+def estimate_human_scores(maze_problem, rng_agent, num_of_seeds=300, time_remaining=None, human_simulation_mode='sequential', num_of_workers=None, choice_tolerance=0.01, rao_blackwellize=False, common_random_numbers=False, \
+                          belief_mode='exact', max_hypotheses=1024):
+    # estimate the ai and human scores that drive the switching decision, and return the number of rollouts used
+    # the sequential and parallel rollouts update the belief of the simulated human with belief_mode; the other modes do not update it
+    if common_random_numbers and human_simulation_mode not in ('sequential', 'vectorized', 'exact'):
+        raise ValueError('Common random numbers are only supported by the sequential, vectorized and exact human simulations')
+    if belief_mode == 'factored' and human_simulation_mode == 'exact':
+        # the exact simulations enumerate every traffic configuration the human considers possible
+        traffic_probs = np.array([traffic_prob for _, _, traffic_prob in maze_problem.human_agent.belief.traffic_locs], dtype=float)
+        num_of_uncertain = int(np.sum((traffic_probs > 0) & (traffic_probs < 1)))
+        if 2**num_of_uncertain > max_hypotheses:
+            raise ValueError('The %s human simulations enumerate 2^%d traffic configurations, more than max_hypotheses=%d; use the sampled human simulations with the factored belief mode' \
+                             % (human_simulation_mode, num_of_uncertain, max_hypotheses))
+    if human_simulation_mode == 'sequential':
+        ai_score, human_score = human_simulations(maze_problem, rng_agent, num_of_seeds=num_of_seeds, time_remaining=time_remaining, common_random_numbers=common_random_numbers, \
+                                                    belief_mode=belief_mode, max_hypotheses=max_hypotheses)
+    elif human_simulation_mode == 'vectorized':
+        ai_score, human_score = vectorized_human_simulations(maze_problem, rng_agent, num_of_seeds=num_of_seeds, time_remaining=time_remaining, common_random_numbers=common_random_numbers)
+    elif human_simulation_mode == 'parallel':
+        ai_score, human_score = parallel_human_simulations(maze_problem, rng_agent, num_of_seeds=num_of_seeds, time_remaining=time_remaining, num_of_workers=num_of_workers, \
+                                                             belief_mode=belief_mode, max_hypotheses=max_hypotheses)
+    elif human_simulation_mode == 'exact':
+        # no sampling, the scores are computed from the exact completion time distributions
+        ai_score, human_score = exact_human_simulations(maze_problem, time_remaining=time_remaining)
+        return ai_score, human_score, 0
+    elif human_simulation_mode == 'stratified':
+        # rao-blackwellized simulations use at least one rollout per traffic configuration
+        return stratified_human_simulations(maze_problem, rng_agent, num_of_seeds=num_of_seeds, time_remaining=time_remaining, rao_blackwellize=rao_blackwellize)
+    elif human_simulation_mode == 'adaptive':
+        # at most num_of_seeds rollouts per driver, fewer when the switching decision is clear
+        return adaptive_human_simulations(maze_problem, rng_agent, num_of_seeds=num_of_seeds, time_remaining=time_remaining, tolerance=choice_tolerance)
+    else:
+        raise ValueError('Unknown human simulation mode: %s' % human_simulation_mode)
+    return ai_score, human_score, 2*num_of_seeds
 
-def simulate(maze_problem, logs, verbose=0, override=False, given_responses=None, counterfactual_seed=None, counterfactual_ai_scaler=None, counterfactual_human_scaler=None, horizon=None, human_prob_estimates_file=None):
+def simulate(maze_problem, logs, verbose=0, override=False, given_responses=None, counterfactual_seed=None, counterfactual_ai_scaler=None, counterfactual_human_scaler=None, horizon=None, human_prob_estimates_file=None, incremental_planning=False, human_simulation_mode='sequential', num_of_workers=None, choice_tolerance=0.01, rao_blackwellize=False, belief_mode='exact', max_hypotheses=1024, log_level='full', log_sink=None, common_random_numbers=False, stop_at_counterfactual=False, snapshot=None):
 
     # initialization
-    initialize_logs(maze_problem, logs)
-    rng_agent = default_rng(seed=maze_problem.agent_seed)
-    # initialize the object where the user's responses to the prompts are stored in the case of override
-    record_responses = []
-    # initialize all tiles as unexplored, except for the ones in the field of vision of the vehicle
-    tiles_explored = np.zeros(maze_problem.env.state.maze_map.shape, dtype=int).tolist()
-    update_explored_tiles(maze_problem, tiles_explored, maze_problem.env.state.vehicle_loc)
-    switching_disabled = False # this is to disable further switching after they have switched once
+    if log_sink is not None and log_level != 'full':
+        raise ValueError('Only full logs can be streamed to a log sink')
+    if log_sink is not None and (stop_at_counterfactual or snapshot is not None):
+        raise ValueError('Snapshots of an episode cannot be streamed to a log sink')
+    # settings of the simulation that carry over to the continuations of a snapshot
+    settings = {'override': override, 'horizon': horizon, 'human_prob_estimates_file': human_prob_estimates_file, 'incremental_planning': incremental_planning, \
+                'human_simulation_mode': human_simulation_mode, 'num_of_workers': num_of_workers, 'choice_tolerance': choice_tolerance, 'rao_blackwellize': rao_blackwellize, \
+                'belief_mode': belief_mode, 'max_hypotheses': max_hypotheses, 'log_level': log_level, 'common_random_numbers': common_random_numbers}
+    # with common random numbers, every draw comes from a stream of its own (see common_random_stream)
+    def draws(t, role):
+        if not common_random_numbers:
+            return rng_agent
+        if role in ('driver', 'codriver'):
+            # the actions are indexed by the location and the number of earlier actions there, the other draws by the time step
+            vehicle_row, vehicle_col = maze_problem.env.state.vehicle_loc
+            visit = num_of_decisions.get((role, vehicle_row, vehicle_col), 0)
+            num_of_decisions[(role, vehicle_row, vehicle_col)] = visit+1
+            return common_random_stream(draws_seed, role, vehicle_row, vehicle_col, visit)
+        return common_random_stream(draws_seed, role, t)
+
+    if snapshot is None:
+        initialize_logs(maze_problem, logs, log_level)
+        if log_sink is not None:
+            log_sink.write_header(logs)
+        rng_agent = default_rng(seed=maze_problem.agent_seed)
+        draws_seed = maze_problem.agent_seed
+        num_of_decisions = {}
+        # initialize the object where the user's responses to the prompts are stored in the case of override
+        record_responses = []
+        # initialize all tiles as unexplored, except for the ones in the field of vision of the vehicle
+        tiles_explored = np.zeros(maze_problem.env.state.maze_map.shape, dtype=int).tolist()
+        if log_level != 'none':
+            update_explored_tiles(maze_problem, tiles_explored, maze_problem.env.state.vehicle_loc)
+        switching_disabled = False # this is to disable further switching after they have switched once
+
+        costs_to_go = plan(maze_problem, incremental=incremental_planning)
 
-    costs_to_go = plan(maze_problem)
+        if log_level == 'full' and log_sink is None:
+            logs['time_steps'] = []
+        t=0
+    else:
+        # resume the episode from a snapshot taken at the counterfactual point (maze_problem and logs are the snapshot's),
+        # with the counterfactual seed and scalers
+        if settings != snapshot.settings:
+            raise ValueError('An episode is resumed from a snapshot with the settings of the snapshot')
+        costs_to_go, tiles_explored, t = snapshot.costs_to_go, snapshot.tiles_explored, snapshot.t
+        action, codriver_action = snapshot.action, snapshot.codriver_action
+        switching_disabled, record_responses, num_of_decisions = snapshot.switching_disabled, snapshot.record_responses, snapshot.num_of_decisions
+        rng_agent = default_rng(seed=counterfactual_seed)
+        draws_seed = counterfactual_seed
+        maze_problem.human_agent.policy_model.set_scaler(counterfactual_human_scaler)
+        maze_problem.ai_agent.policy_model.set_scaler(counterfactual_ai_scaler)
 
-    logs['time_steps'] = []
-    t=0
     while maze_problem.env.state.vehicle_loc != maze_problem.env.state.goal_loc:
         
         if verbose>0:
@@ -355,15 +576,15 @@ def simulate(maze_problem, logs, verbose=0, override=False, given_responses=None
         # check if the current vehicle_loc is a traffic location
         is_in_traffic = False
         for traffic_x, traffic_y, traffic_bool in maze_problem.env.state.traffic_locs:
-            if maze_problem.env.state.vehicle_loc == [traffic_x, traffic_y] and traffic_bool == 1:
+            if maze_problem.env.state.vehicle_loc == (traffic_x, traffic_y) and traffic_bool == 1:
                 is_in_traffic = True
                 break
         
         # get next action depending on which agent is currently in control
         if maze_problem.env.state.agent_name == 'ai':
             # the ai moves on the shortest path given the current traffic conditions
-            action = maze_problem.ai_agent.act(costs_to_go['ai'][str(maze_problem.ai_agent.belief.traffic_locs)], rng_agent, maze_problem.env.state.committed_action, is_in_traffic)
-            codriver_action = maze_problem.human_agent.act(costs_to_go['human'][str(maze_problem.human_agent.belief.traffic_locs)], rng_agent, maze_problem.env.state.committed_action, is_in_traffic)
+            action = maze_problem.ai_agent.act(costs_to_go['ai'][traffic_key(maze_problem.ai_agent.belief.traffic_locs)], draws(t, 'driver'), maze_problem.env.state.committed_action, is_in_traffic)
+            codriver_action = maze_problem.human_agent.act(costs_to_go['human'][traffic_key(maze_problem.human_agent.belief.traffic_locs)], draws(t, 'codriver'), maze_problem.env.state.committed_action, is_in_traffic)
             if override and not switching_disabled:
                 if verbose > 0:
                     print("Current state:\n", maze_problem.env.state)
@@ -385,8 +606,8 @@ def simulate(maze_problem, logs, verbose=0, override=False, given_responses=None
                         action.dir = action.dir[0]
         elif maze_problem.env.state.agent_name == 'human':
             # the human moves on the shortest expected path given their current belief about the traffic conditions 
-            action = maze_problem.human_agent.act(costs_to_go['human'][str(maze_problem.human_agent.belief.traffic_locs)], rng_agent, maze_problem.env.state.committed_action, is_in_traffic)
-            codriver_action = maze_problem.ai_agent.act(costs_to_go['ai'][str(maze_problem.ai_agent.belief.traffic_locs)], rng_agent, maze_problem.env.state.committed_action, is_in_traffic)
+            action = maze_problem.human_agent.act(costs_to_go['human'][traffic_key(maze_problem.human_agent.belief.traffic_locs)], draws(t, 'driver'), maze_problem.env.state.committed_action, is_in_traffic)
+            codriver_action = maze_problem.ai_agent.act(costs_to_go['ai'][traffic_key(maze_problem.ai_agent.belief.traffic_locs)], draws(t, 'codriver'), maze_problem.env.state.committed_action, is_in_traffic)
             if override and not switching_disabled:
                 if verbose > 0:
                     print("Current state:\n", maze_problem.env.state)
@@ -412,29 +633,38 @@ def simulate(maze_problem, logs, verbose=0, override=False, given_responses=None
                 print('No feasible plan after time step %d' % t)
                 print('Terminating early')
             
-            logs['length'] = t
+            finalize_logs(logs, tiles_explored, t, False, horizon, log_level, log_sink)
             return
         
         # update the logs with time step information
-        update_logs(logs, maze_problem, action, codriver_action, tiles_explored, t)
+        update_logs(logs, maze_problem, action, codriver_action, tiles_explored, t, log_level, log_sink)
         
         # bayesian update of the human's belief about the traffic conditions, based on the direction that the ai is planning to follow
         belief_changed = False
         if maze_problem.env.state.agent_name == 'ai':
             belief_action = copy.deepcopy(action)
             belief_action.dir = belief_action.dir[0]
-            bayesian_human_belief = bayesian_update(maze_problem, maze_problem.human_agent.belief, costs_to_go, belief_action)
+            if belief_mode == 'factored':
+                bayesian_human_belief = factored_bayesian_update(maze_problem, maze_problem.human_agent.belief, costs_to_go, belief_action, max_hypotheses=max_hypotheses)
+            else:
+                bayesian_human_belief = bayesian_update(maze_problem, maze_problem.human_agent.belief, costs_to_go, belief_action)
             # this is to avoid numerical errors
             if not np.allclose(np.array(maze_problem.human_agent.belief.traffic_locs), np.array(bayesian_human_belief.traffic_locs)):
                 belief_changed = True
                 maze_problem.human_agent.set_belief(bayesian_human_belief)
 
         # agent switching mechanism
+        start_counterfactual = False
         if action.dir in {'uc', 'dc', 'lc', 'rc'}:
             
+            time_remaining = None if horizon is None else horizon-t
             if human_prob_estimates_file is None:
                 # perform human-ai simulations and compute the average completion times
-                ai_score, human_score = human_simulations(maze_problem, rng_agent, num_of_seeds=300, time_remaining=horizon-t)
+                ai_score, human_score, num_of_rollouts = estimate_human_scores(maze_problem, draws(t, 'simulations'), num_of_seeds=300, time_remaining=time_remaining, human_simulation_mode=human_simulation_mode, \
+                                                                               num_of_workers=num_of_workers, choice_tolerance=choice_tolerance, rao_blackwellize=rao_blackwellize, \
+                                                                               common_random_numbers=common_random_numbers, belief_mode=belief_mode, max_hypotheses=max_hypotheses)
+                if verbose > 0:
+                    print('Human simulations used %d rollouts' % num_of_rollouts)
             else:
                 try:
                     with open(human_prob_estimates_file, 'r') as f:
@@ -443,15 +673,19 @@ def simulate(maze_problem, logs, verbose=0, override=False, given_responses=None
                         human_score = human_prob_estimates['human_score']
                 except:
                     # perform human-ai simulations and compute the average completion times
-                    ai_score, human_score = human_simulations(maze_problem, rng_agent, num_of_seeds=300, time_remaining=horizon-t)
+                    ai_score, human_score, num_of_rollouts = estimate_human_scores(maze_problem, draws(t, 'simulations'), num_of_seeds=300, time_remaining=time_remaining, human_simulation_mode=human_simulation_mode, \
+                                                                                   num_of_workers=num_of_workers, choice_tolerance=choice_tolerance, rao_blackwellize=rao_blackwellize, \
+                                                                                   common_random_numbers=common_random_numbers, belief_mode=belief_mode, max_hypotheses=max_hypotheses)
+                    if verbose > 0:
+                        print('Human simulations used %d rollouts' % num_of_rollouts)
                     # save the scores to a file
                     with open(human_prob_estimates_file, 'w') as f:
-                        json.dump({'ai_score': ai_score, 'human_score': human_score}, f, cls=NpEncoder)
+                        json.dump({'ai_score': ai_score, 'human_score': human_score, 'num_of_rollouts': num_of_rollouts}, f, cls=NpEncoder)
             
             # the agent decides to taker over or confirm the ai's direction by sampling from a softmax policy
             logits = [maze_problem.sim_scaler * ai_score, maze_problem.sim_scaler * human_score]    # NOTE: sim_scaler temperature is set independently from the agents' policy scalers
             softmax_scores = np.exp(logits) / np.sum(np.exp(logits))
-            choice = rng_agent.choice(a=['ai', 'human'], p=softmax_scores)
+            choice = draws(t, 'choice').choice(a=['ai', 'human'], p=softmax_scores)
             if maze_problem.env.state.agent_name == 'ai' and override:
 
                 if given_responses is not None:
@@ -512,10 +746,7 @@ def simulate(maze_problem, logs, verbose=0, override=False, given_responses=None
             if maze_problem.env.state.agent_name != choice:
                 # if the chosen and the current agents are different, the state remains
                 # the same, no commited action is set, and the agent changes
-                next_state = copy.deepcopy(maze_problem.env.state)
-                next_state.time_idle += 1
-                next_state.committed_action = 'none'
-                next_state.agent_name = choice
+                next_state = maze_problem.env.state.replace(time_idle=maze_problem.env.state.time_idle+1, committed_action='none', agent_name=choice)
                 reward = maze_problem.env.reward_model.sample(maze_problem.env.state, next_state)
                 # no further switching after the first switch
                 maze_problem.human_agent.set_switching_off()
@@ -535,6 +766,7 @@ def simulate(maze_problem, logs, verbose=0, override=False, given_responses=None
                 switching_disabled = True
                 # change the agent seed and scalers
                 rng_agent = default_rng(seed=counterfactual_seed)
+                draws_seed = counterfactual_seed
                 maze_problem.human_agent.policy_model.set_scaler(counterfactual_human_scaler)
                 maze_problem.ai_agent.policy_model.set_scaler(counterfactual_ai_scaler)
 
@@ -552,7 +784,8 @@ def simulate(maze_problem, logs, verbose=0, override=False, given_responses=None
         maze_problem.env.apply_transition(next_state)
         
         # update the explored tiles
-        update_explored_tiles(maze_problem, tiles_explored, next_state.vehicle_loc)
+        if log_level != 'none':
+            update_explored_tiles(maze_problem, tiles_explored, next_state.vehicle_loc)
 
         # add observations to the agents' histories
         maze_problem.ai_agent.update_history(action, ai_observation)
@@ -577,21 +810,80 @@ def simulate(maze_problem, logs, verbose=0, override=False, given_responses=None
                 """)
             maze_problem.ai_agent.set_belief(new_ai_belief)
             maze_problem.human_agent.set_belief(new_human_belief)    
-            costs_to_go = plan(maze_problem)
+            costs_to_go = plan(maze_problem, incremental=incremental_planning)
         else:
             maze_problem.ai_agent.set_belief(new_ai_belief)
             maze_problem.human_agent.set_belief(new_human_belief)
         t += 1
 
+        if start_counterfactual and stop_at_counterfactual:
+            # everything up to here is common to the counterfactual continuations, which resume from the snapshot
+            return SimulationSnapshot(maze_problem, logs, costs_to_go, tiles_explored, t, action, codriver_action, switching_disabled, record_responses, \
+                                      given_responses, num_of_decisions, settings)
+
     # update the logs with the last time step information
-    update_logs(logs, maze_problem, action, codriver_action, tiles_explored, t)
+    update_logs(logs, maze_problem, action, codriver_action, tiles_explored, t, log_level, log_sink)
     if verbose:
         print('Goal reached in %d steps' % t)
-    logs['length'] = t+1
+    finalize_logs(logs, tiles_explored, t+1, True, horizon, log_level, log_sink)
 
     # return the user keyboard responses to the prompts (if any)
     return record_responses
 
+def run_episode(init_true_state, agent_seed=42, traffic_delay=10, human_scaler=None, ai_scaler=None, ai_switching=0.0, human_switching=0.0, radius=1, verbose=0, sim_scaler=1.0, \
+                override=False, given_responses=None, semi_manual_seed=None, horizon=None, human_prob_estimates_file=None, incremental_planning=False, human_simulation_mode='sequential', \
+                num_of_workers=None, choice_tolerance=0.01, rao_blackwellize=False, belief_mode='exact', max_hypotheses=1024, log_level='full', log_sink=None, \
+                common_random_numbers=False):
+    """
+    Creates the maze problem from an initial state and simulates one episode,
+    returns the episode's logs and the user's responses to the prompts
+    """
+    if semi_manual_seed is None:
+        maze_problem = MazeProblem.create(init_true_state=init_true_state, agent_seed=agent_seed, traffic_delay=traffic_delay, radius=radius, human_scaler=human_scaler, \
+                                ai_scaler=ai_scaler, ai_switching=ai_switching, human_switching=human_switching, sim_scaler=sim_scaler)
+    else:
+        maze_problem = MazeProblem.create(init_true_state=init_true_state, agent_seed=semi_manual_seed, traffic_delay=traffic_delay, radius=radius, human_scaler=None, \
+                                ai_scaler=None, ai_switching=ai_switching, human_switching=human_switching, sim_scaler=sim_scaler)
+    
+    # simulate the episode
+    logs = {}
+    simulation_responses = simulate(maze_problem=maze_problem, logs=logs, verbose=verbose, override=override, given_responses=given_responses, counterfactual_seed=agent_seed, \
+                                    counterfactual_ai_scaler=ai_scaler, counterfactual_human_scaler=human_scaler, horizon=horizon, human_prob_estimates_file=human_prob_estimates_file, \
+                                    incremental_planning=incremental_planning, human_simulation_mode=human_simulation_mode, num_of_workers=num_of_workers, choice_tolerance=choice_tolerance, rao_blackwellize=rao_blackwellize, \
+                                    belief_mode=belief_mode, max_hypotheses=max_hypotheses, log_level=log_level, log_sink=log_sink, \
+                                    common_random_numbers=common_random_numbers)
+    
+    return logs, simulation_responses
+
+def run_prefix(init_true_state, given_responses, semi_manual_seed, traffic_delay=10, ai_switching=0.0, human_switching=0.0, radius=1, verbose=0, sim_scaler=1.0, \
+               horizon=None, human_prob_estimates_file=None, incremental_planning=False, human_simulation_mode='sequential', num_of_workers=None, choice_tolerance=0.01, \
+               rao_blackwellize=False, belief_mode='exact', max_hypotheses=1024, log_level='full', common_random_numbers=False):
+    """
+    Simulates the factual prefix of a semi-counterfactual episode (see run_episode with override and semi_manual_seed) once,
+    up to the counterfactual prompt ('ycf' or 'ncf') of the given responses. Returns the snapshot at the counterfactual point,
+    or None and the logs of the complete episode if the responses have no counterfactual prompt
+    """
+    maze_problem = MazeProblem.create(init_true_state=init_true_state, agent_seed=semi_manual_seed, traffic_delay=traffic_delay, radius=radius, human_scaler=None, \
+                            ai_scaler=None, ai_switching=ai_switching, human_switching=human_switching, sim_scaler=sim_scaler)
+    logs = {}
+    snapshot = simulate(maze_problem=maze_problem, logs=logs, verbose=verbose, override=True, given_responses=given_responses, horizon=horizon, human_prob_estimates_file=human_prob_estimates_file, \
+                        incremental_planning=incremental_planning, human_simulation_mode=human_simulation_mode, num_of_workers=num_of_workers, choice_tolerance=choice_tolerance, \
+                        rao_blackwellize=rao_blackwellize, belief_mode=belief_mode, max_hypotheses=max_hypotheses, log_level=log_level, common_random_numbers=common_random_numbers, \
+                        stop_at_counterfactual=True)
+    if not isinstance(snapshot, SimulationSnapshot):
+        return None, logs
+    return snapshot, None
+
+def run_fork(snapshot, agent_seed=42, human_scaler=None, ai_scaler=None, verbose=0):
+    """
+    Simulates one counterfactual continuation of a snapshot taken by run_prefix, with the agent seed and scalers of the
+    counterfactual simulation. The snapshot is left untouched. Returns the episode's logs, as run_episode would
+    """
+    fork = snapshot.fork()
+    _ = simulate(maze_problem=fork.maze_problem, logs=fork.logs, verbose=verbose, given_responses=fork.given_responses, counterfactual_seed=agent_seed, \
+                 counterfactual_ai_scaler=ai_scaler, counterfactual_human_scaler=human_scaler, snapshot=fork, **fork.settings)
+    return fork.logs
+
 @click.command()
 @click.option('--log_file', type=str, required=True, help='Directory where to place the trajectory logs')
 @click.option('--world_file', type=str, required=True, help='World to use')
@@ -610,9 +902,22 @@ def simulate(maze_problem, logs, verbose=0, override=False, given_responses=None
 @click.option('--semi_manual_seed', type=int, default=None, help='Seed for the factual part of a semi-counterfactual episode')
 @click.option('--horizon', type=int, default=None, help='Horizon (time limit) of the episode')
 @click.option('--human_prob_estimates_file', type=str, default=None, help='File where the human and ai scores are stored, serves as cache')
-def execute_episode(log_file, world_file, traffic_delay, human_scaler, ai_scaler, ai_switching, human_switching, radius, agent_seed, verbose, sim_scaler, initial_agent, override, responses_file, semi_manual_seed, horizon, human_prob_estimates_file):
+@click.option('--incremental_planning', is_flag=True, default=False, help='If true, replanning after a belief change only repairs the affected cost-to-go values')
+@click.option('--human_simulation_mode', type=click.Choice(['sequential', 'vectorized', 'parallel', 'exact', 'adaptive', 'stratified']), default='sequential', help='How the human simulations behind the switching decisions are run')
+@click.option('--choice_tolerance', type=float, default=0.01, help='The adaptive human simulations stop once the probability of switching is known within this tolerance')
+@click.option('--rao_blackwellize', is_flag=True, default=False, help='If true, the stratified human simulations weight traffic configurations by their prior instead of sampling them (unless there are more configurations than seeds)')
+@click.option('--belief_mode', type=click.Choice(['exact', 'factored']), default='exact', help="How the human's belief is updated from the ai's actions ('factored' keeps per-spot marginals, for worlds with many traffic spots)")
+@click.option('--max_hypotheses', type=int, default=1024, help='In the factored belief mode, beliefs with at most this many traffic hypotheses are still updated exactly')
+@click.option('--num_of_workers', type=int, default=None, help='Number of processes used by the parallel human simulations (default: all cores)')
+@click.option('--log_level', type=click.Choice(['none', 'summary', 'full']), default='full', help="What is logged: 'full' logs every time step, 'summary' the length, success and aggregates of the episode, 'none' only the length and success")
+@click.option('--log_format', type=click.Choice(['json', 'columnar', 'jsonl']), default='json', help="Format of the log file ('columnar' is a compact binary format, 'jsonl' is written while the episode runs, see episode_logs.py)")
+@click.option('--common_random_numbers', is_flag=True, default=False, help='If true, the random draws are indexed by time step and role, so that episodes with the same seed and different scalers share them')
+def execute_episode(log_file, world_file, traffic_delay, human_scaler, ai_scaler, ai_switching, human_switching, radius, agent_seed, verbose, sim_scaler, initial_agent, override, responses_file, semi_manual_seed, horizon, human_prob_estimates_file, incremental_planning, human_simulation_mode, num_of_workers, choice_tolerance, rao_blackwellize, belief_mode, max_hypotheses, log_level, log_format, common_random_numbers):
     
     verbose = int(verbose)
+    # checked before the log file is created by the log sink
+    if log_format == 'jsonl' and log_level != 'full':
+        raise click.UsageError('--log_format=jsonl streams the time steps of the episode and needs --log_level=full')
     if override:
         # check if the file store_responses_file exists and read the responses
         try:
@@ -643,17 +948,18 @@ def execute_episode(log_file, world_file, traffic_delay, human_scaler, ai_scaler
         record_responses = []
     
     init_true_state = MazeState(*parse_initial_state(world_file, initial_agent))
-    if semi_manual_seed is None:
-        maze_problem = MazeProblem.create(init_true_state=init_true_state, agent_seed=agent_seed, traffic_delay=traffic_delay, radius=radius, human_scaler=human_scaler, \
-                                ai_scaler=ai_scaler, ai_switching=ai_switching, human_switching=human_switching, sim_scaler=sim_scaler)
-    else:
-        maze_problem = MazeProblem.create(init_true_state=init_true_state, agent_seed=semi_manual_seed, traffic_delay=traffic_delay, radius=radius, human_scaler=None, \
-                                ai_scaler=None, ai_switching=ai_switching, human_switching=human_switching, sim_scaler=sim_scaler)
-    
-    # simulate the episode
-    logs = {}
-    simulation_responses = simulate(maze_problem=maze_problem, logs=logs, verbose=verbose, override=override, given_responses=given_responses, counterfactual_seed=agent_seed, \
-                                    counterfactual_ai_scaler=ai_scaler, counterfactual_human_scaler=human_scaler, horizon=horizon, human_prob_estimates_file=human_prob_estimates_file)
+    # streaming logs are written to the log file while the episode runs
+    log_sink = StreamingLogWriter(log_file) if log_format == 'jsonl' else None
+    try:
+        logs, simulation_responses = run_episode(init_true_state=init_true_state, agent_seed=agent_seed, traffic_delay=traffic_delay, human_scaler=human_scaler, ai_scaler=ai_scaler, \
+                                                 ai_switching=ai_switching, human_switching=human_switching, radius=radius, verbose=verbose, sim_scaler=sim_scaler, override=override, \
+                                                 given_responses=given_responses, semi_manual_seed=semi_manual_seed, horizon=horizon, human_prob_estimates_file=human_prob_estimates_file, \
+                                                 incremental_planning=incremental_planning, human_simulation_mode=human_simulation_mode, num_of_workers=num_of_workers, \
+                                                 choice_tolerance=choice_tolerance, rao_blackwellize=rao_blackwellize, belief_mode=belief_mode, max_hypotheses=max_hypotheses, \
+                                                 log_level=log_level, log_sink=log_sink, common_random_numbers=common_random_numbers)
+    finally:
+        if log_sink is not None:
+            log_sink.close()
     record_responses = record_responses + simulation_responses
 
     def remove_suffix(input_string, suffix):
@@ -672,7 +978,9 @@ def execute_episode(log_file, world_file, traffic_delay, human_scaler, ai_scaler
             while special == '':
                 special = input('Please give a non-empty word: ')
             record_responses.append(special)
-        log_file = remove_suffix(log_file, '.json') + '_initagent:' + initial_agent + '_explanation:' + special + '.json'
+        extension = LOG_EXTENSIONS[log_format]
+        streamed_log_file = log_file
+        log_file = remove_suffix(log_file, extension) + '_initagent:' + initial_agent + '_explanation:' + special + extension
         responses_file = remove_suffix(responses_file, '.pkl') + '_explanation:' + special + '.pkl'
 
     if override and given_responses is None:
@@ -680,8 +988,10 @@ def execute_episode(log_file, world_file, traffic_delay, human_scaler, ai_scaler
         with open(responses_file, 'wb') as f:
             pkl.dump(record_responses, f)
 
-    with open(log_file, 'w') as f:
-        json.dump(logs, f, cls=NpEncoder)
+    if log_sink is None:
+        write_logs(logs, log_file, log_format)
+    elif override:
+        os.replace(streamed_log_file, log_file)
     
 if __name__ == '__main__':
     # NOTE: the following commented line is only for testing purposes
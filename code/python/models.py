@@ -25,13 +25,13 @@ class ObservationModel(pomdp_py.ObservationModel):
         if self._is_in_field_of_vision(v_loc, next_state.closure_loc) or self.agent_name == 'human':
             closure_loc = next_state.closure_loc
         else:
-            closure_loc = [-1, -1]  # no closure in the field of vision
+            closure_loc = (-1, -1)  # no closure in the field of vision
 
         # accident are unknown to both the human and ai, unless they are in the field of vision
         if self._is_in_field_of_vision(v_loc, next_state.accident_loc):
             accident_loc = next_state.accident_loc
         else:
-            accident_loc = [-1, -1] # no accident in the field of vision
+            accident_loc = (-1, -1) # no accident in the field of vision
         
         traffic_locs = []
         for traffic_x, traffic_y, traffic_bool in next_state.traffic_locs:
@@ -65,58 +65,41 @@ class TransitionModel(pomdp_py.TransitionModel):
     def _is_stuck_in_traffic(self, v_loc, traffic_locs):
         
         for traffic_loc in traffic_locs:
-            if traffic_loc == [v_loc[0], v_loc[1], 1]:
+            if traffic_loc == (v_loc[0], v_loc[1], 1):
                 return True
         
         return False
     
-    def _get_candidate_v_loc(self, v_loc, action):
-        if action.dir == 'r':
-            return v_loc[0], v_loc[1]+1
-        elif action.dir == 'l':
-            return v_loc[0], v_loc[1]-1
-        elif action.dir == 'u':
-            return v_loc[0]-1, v_loc[1]
-        elif action.dir == 'd':
-            return v_loc[0]+1, v_loc[1]
-        
     def get_next_state(self, state, action):
         
         if action.dir == 'rc' or action.dir == 'lc' or action.dir == 'uc' or action.dir == 'dc':
             # stay in the same tile, ask to switch control and commit to next action
-            next_state = copy.deepcopy(state)
-            next_state.time_idle += 1
-            next_state.committed_action = action.dir[0]
-            return next_state
+            return state.replace(time_idle=state.time_idle+1, committed_action=action.dir[0])
         
         v_loc = state.vehicle_loc
         stuck = self._is_stuck_in_traffic(v_loc, state.traffic_locs)
         
+        # NOTE: next states share the maze and the unchanged fields with the current state (copy-on-write)
         if stuck and (state.time_idle < self.traffic_delay + (state.agent_name == 'human') * self.human_penalty):
             # stuck in traffic
-            next_state = copy.deepcopy(state)
-            next_state.time_idle += 1
+            next_state = state.replace(time_idle=state.time_idle+1, committed_action='none')
         elif state.agent_name == 'human' and state.time_idle < self.human_penalty:
             # human needs additional time before moving to another tile
-            next_state = copy.deepcopy(state)
-            next_state.time_idle += 1
+            next_state = state.replace(time_idle=state.time_idle+1, committed_action='none')
         else:
             
             # try to move in the direction of the action
-            candidate_v_loc = self._get_candidate_v_loc(v_loc, action)
-            is_in_map_boundaries = (0 <= candidate_v_loc[0] < state.maze_map.shape[0]) and (0 <= candidate_v_loc[1] < state.maze_map.shape[1])
+            maze_map = state.maze_map
+            n_cols = maze_map.shape[1]
+            next_cell = maze_map.next_cell_lists[v_loc[0]*n_cols + v_loc[1]][maze_map.ACTION_INDEX[action.dir]]
             
             # out of bounds --or-- going on a wall --or-- going on an accident --or-- going on a road closure
-            if (not is_in_map_boundaries) or (state.maze_map[candidate_v_loc] == '*') or (state.accident_loc == list(candidate_v_loc)) or (state.closure_loc == list(candidate_v_loc)):
+            if (next_cell < 0) or (not maze_map.passable_list[next_cell]) or (next_cell in maze_map.blocked_cells(state.accident_loc, state.closure_loc)):
                 # cannot move that way
-                next_state = copy.deepcopy(state)
-                next_state.time_idle += 1
+                next_state = state.replace(time_idle=state.time_idle+1, committed_action='none')
             else:
-                next_state = copy.deepcopy(state)
-                next_state.vehicle_loc = list(candidate_v_loc)
-                next_state.time_idle = 0
+                next_state = state.replace(vehicle_loc=[next_cell // n_cols, next_cell % n_cols], time_idle=0, committed_action='none')
 
-        next_state.committed_action = 'none'
         return next_state
 
     def probability(self, next_state, state, action):
@@ -1,4 +1,9 @@
 import heapq
+import ast
+import copy
+from itertools import product
+from collections import OrderedDict
+import numpy as np
 
 class Planner:
 
@@ -30,7 +35,7 @@ class Planner:
         
         current_traffic_spot = [-1, -1, -1]
         for traffic_loc in self.traffic_locs:
-            if n1 == traffic_loc[:2]:
+            if list(n1) == list(traffic_loc[:2]):
                 current_traffic_spot = traffic_loc
         
         if (current_traffic_spot[0] == -1):
@@ -47,7 +52,7 @@ class Planner:
         for action in ACTIONS:
             candidate_v_loc = self._get_candidate_v_loc(node, action)
             is_in_map_boundaries = (0 <= candidate_v_loc[0] < self.maze_map.shape[0]) and (0 <= candidate_v_loc[1] < self.maze_map.shape[1])
-            if (is_in_map_boundaries) and (self.maze_map[candidate_v_loc] == '-') and (list(candidate_v_loc) != self.closure_loc) and (list(candidate_v_loc) != self.accident_loc):
+            if (is_in_map_boundaries) and self.maze_map.passable[candidate_v_loc] and (list(candidate_v_loc) != list(self.closure_loc)) and (list(candidate_v_loc) != list(self.accident_loc)):
                 adjacent_locs.append(list(candidate_v_loc))
         
         next_nodes = []
@@ -87,3 +92,432 @@ class Planner:
                     heapq.heappush(heap, (new_cost, counter, neighbor))
         
         return cost_to_go
+
+
+class CostToGo:
+    """
+    Array-backed cost-to-go field, indexed like the dictionary returned by Planner.dijkstra,
+    i.e. with keys of the form str([x, y]). Unreachable cells hold inf and are treated as missing keys.
+    """
+    def __init__(self, array):
+        self.array = array
+
+    def _loc(self, key):
+        x, y = key[1:-1].split(',')
+        return int(x), int(y)
+
+    def __getitem__(self, key):
+        try:
+            loc = self._loc(key)
+        except ValueError:
+            raise KeyError(key)
+        if not (0 <= loc[0] < self.array.shape[0] and 0 <= loc[1] < self.array.shape[1]) or self.array[loc] == float('inf'):
+            raise KeyError(key)
+        return self.array[loc]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [str([int(x), int(y)]) for x, y in zip(*np.where(self.array != float('inf')))]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return int(np.sum(self.array != float('inf')))
+
+
+class BucketPlanner(Planner):
+    """
+    Drop-in replacement for Planner that runs over a flat grid of cell indices. When all edge costs are
+    integers (i.e. traffic is known to be present or absent) it uses a bucket queue (Dial's algorithm),
+    otherwise (e.g. expected traffic costs of the human) it falls back to a binary heap over the flat grid.
+    """
+
+    def _get_edge_costs(self):
+        # cost of leaving each cell towards the goal, see Planner._compute_edge_cost
+        base_cost = 1
+        edge_costs = np.full(self.maze_map.shape, base_cost, dtype=float)
+        for traffic_loc in self.traffic_locs:
+            edge_costs[traffic_loc[0], traffic_loc[1]] = base_cost + int(self.traffic_delay)*traffic_loc[2]
+        return edge_costs
+
+    def _get_passable(self):
+        passable = self.maze_map.passable.copy()
+        passable.ravel()[self.maze_map.blocked_cells(self.closure_loc, self.accident_loc)] = False
+        return passable
+
+    def _get_flat_neighbors(self):
+        # for every flat cell index, the flat indices of its passable neighbors ('r', 'l', 'u', 'd' order)
+        return self.maze_map.neighbors_without(self.maze_map.blocked_cells(self.closure_loc, self.accident_loc))
+
+    def _bucket_queue(self, goal, neighbors, edge_costs, cost_to_go):
+        # Dial's algorithm: all edge costs are positive integers bounded by max_cost
+        max_cost = int(max(edge_costs))
+        buckets = [[] for _ in range(max_cost+1)]
+        buckets[0].append(goal)
+        pending = 1
+        current_cost = 0
+        while pending:
+            bucket = buckets[current_cost % (max_cost+1)]
+            while bucket:
+                node = bucket.pop()
+                pending -= 1
+                # skip stale entries, the node has already been settled with a lower cost
+                if cost_to_go[node] != current_cost:
+                    continue
+                for neighbor in neighbors[node]:
+                    new_cost = current_cost + edge_costs[neighbor]
+                    if new_cost < cost_to_go[neighbor]:
+                        cost_to_go[neighbor] = new_cost
+                        buckets[new_cost % (max_cost+1)].append(neighbor)
+                        pending += 1
+            current_cost += 1
+
+    def _heap_queue(self, goal, neighbors, edge_costs, cost_to_go):
+        heap = [(0, goal)]
+        while heap:
+            current_cost, node = heapq.heappop(heap)
+            if current_cost > cost_to_go[node]:
+                continue
+            for neighbor in neighbors[node]:
+                new_cost = current_cost + edge_costs[neighbor]
+                if new_cost < cost_to_go[neighbor]:
+                    cost_to_go[neighbor] = new_cost
+                    heapq.heappush(heap, (new_cost, neighbor))
+
+    def dijkstra(self):
+
+        n_rows, n_cols = self.maze_map.shape
+        edge_costs = self._get_edge_costs().ravel()
+        neighbors = self._get_flat_neighbors()
+        goal = self.goal_loc[0]*n_cols + self.goal_loc[1]
+
+        cost_to_go = [float('inf')]*(n_rows*n_cols)
+        cost_to_go[goal] = 0
+        if np.all(edge_costs == np.floor(edge_costs)):
+            self._bucket_queue(goal, neighbors, edge_costs.astype(int).tolist(), cost_to_go)
+        else:
+            self._heap_queue(goal, neighbors, edge_costs.tolist(), cost_to_go)
+
+        return CostToGo(np.array(cost_to_go, dtype=float).reshape(n_rows, n_cols))
+
+
+class BatchedPlanner(BucketPlanner):
+    """
+    Plans all hypotheses about the uncertain traffic spots in a single vectorized pass. Each hypothesis
+    is a row of traffic_states, giving the traffic value of the spots traffic_locs[unknown_inds].
+    The cost-to-go fields are relaxed jointly (Bellman-Ford over the grid) until none of them changes.
+    """
+
+    def _get_batched_edge_costs(self, unknown_inds, traffic_states):
+        # same as BucketPlanner._get_edge_costs, with one row per hypothesis
+        base_cost = 1
+        n_hypotheses = traffic_states.shape[0]
+        edge_costs = np.full((n_hypotheses,) + self.maze_map.shape, base_cost, dtype=float)
+        unknown_cols = {ind: col for col, ind in enumerate(unknown_inds)}
+        for ind, traffic_loc in enumerate(self.traffic_locs):
+            if ind in unknown_cols:
+                traffic_value = traffic_states[:, unknown_cols[ind]]
+            else:
+                traffic_value = traffic_loc[2]
+            edge_costs[:, traffic_loc[0], traffic_loc[1]] = base_cost + int(self.traffic_delay)*traffic_value
+        return edge_costs
+
+    def dijkstra_batch(self, unknown_inds, traffic_states):
+
+        traffic_states = np.array(traffic_states, dtype=float, ndmin=2)
+        n_hypotheses = traffic_states.shape[0]
+        n_rows, n_cols = self.maze_map.shape
+        edge_costs = self._get_batched_edge_costs(unknown_inds, traffic_states)
+        passable = self._get_passable()
+        goal = (self.goal_loc[0], self.goal_loc[1])
+
+        # pad the fields with an impassable border so that neighbors can be read through slicing
+        cost_to_go = np.full((n_hypotheses, n_rows+2, n_cols+2), float('inf'))
+        cost_to_go[:, goal[0]+1, goal[1]+1] = 0
+        inner = cost_to_go[:, 1:-1, 1:-1]
+        while True:
+            best_neighbor = np.minimum(np.minimum(cost_to_go[:, 1:-1, 2:], cost_to_go[:, 1:-1, :-2]),
+                                       np.minimum(cost_to_go[:, :-2, 1:-1], cost_to_go[:, 2:, 1:-1]))
+            new_cost = np.where(passable, best_neighbor + edge_costs, float('inf'))
+            new_cost[:, goal[0], goal[1]] = 0
+            improved = new_cost < inner
+            if not improved.any():
+                break
+            inner[improved] = new_cost[improved]
+
+        return inner.copy()
+
+
+class IncrementalPlanner(BucketPlanner):
+    """
+    Lifelong planning variant of BucketPlanner (LPA* without heuristic, searching backwards from the goal).
+    The search state is kept between calls, so that after update() only the cells whose cost-to-go is
+    affected by the changed closure, accident or traffic cells are repaired by the next call to dijkstra().
+    """
+
+    def __init__(self, maze_map, goal_loc, accident_loc, closure_loc, traffic_locs, traffic_delay, agent_name):
+        super().__init__(maze_map, goal_loc, accident_loc, closure_loc, traffic_locs, traffic_delay, agent_name)
+        n_rows, n_cols = self.maze_map.shape
+        self._goal = self.goal_loc[0]*n_cols + self.goal_loc[1]
+        # passability may change between calls, so all in-bounds neighbors are tracked
+        self._neighbors = self.maze_map.grid_neighbor_lists
+        self._passable = self._get_passable().ravel().tolist()
+        self._edge_costs = self._get_edge_costs().ravel().tolist()
+        self._cost_to_go = None
+        self._rhs = None
+        self._heap = []
+
+    def _lookahead(self, node):
+        if node == self._goal:
+            return 0
+        if not self._passable[node]:
+            return float('inf')
+        return self._edge_costs[node] + min(self._cost_to_go[neighbor] for neighbor in self._neighbors[node])
+
+    def _update_node(self, node):
+        self._rhs[node] = self._lookahead(node)
+        if self._cost_to_go[node] != self._rhs[node]:
+            heapq.heappush(self._heap, (min(self._cost_to_go[node], self._rhs[node]), node))
+
+    def _compute(self):
+        cost_to_go, rhs = self._cost_to_go, self._rhs
+        while self._heap:
+            key, node = heapq.heappop(self._heap)
+            # skip stale entries
+            if cost_to_go[node] == rhs[node] or key != min(cost_to_go[node], rhs[node]):
+                continue
+            if cost_to_go[node] > rhs[node]:
+                # overconsistent: the cost-to-go decreased
+                cost_to_go[node] = rhs[node]
+            else:
+                # underconsistent: the cost-to-go increased, recompute it from the neighbors
+                cost_to_go[node] = float('inf')
+                self._update_node(node)
+            for neighbor in self._neighbors[node]:
+                self._update_node(neighbor)
+
+    def update(self, accident_loc, closure_loc, traffic_locs):
+        # only the cells of the old and new closure, accident and traffic spots can change
+        candidates = set(self.maze_map.blocked_cells(self.closure_loc, self.accident_loc, closure_loc, accident_loc))
+        old_traffic = {self.maze_map.index(traffic_loc[:2]): traffic_loc[2] for traffic_loc in self.traffic_locs}
+        new_traffic = {self.maze_map.index(traffic_loc[:2]): traffic_loc[2] for traffic_loc in traffic_locs}
+        candidates.update(node for node in old_traffic.keys() | new_traffic.keys() if old_traffic.get(node) != new_traffic.get(node))
+        self.accident_loc = accident_loc
+        self.closure_loc = closure_loc
+        self.traffic_locs = traffic_locs
+
+        # same passability and edge costs as _get_passable and _get_edge_costs, for the candidate cells only
+        blocked = set(self.maze_map.blocked_cells(closure_loc, accident_loc))
+        maze_passable = self.maze_map.passable.ravel()
+        changed = []
+        for node in sorted(candidates):
+            passable = bool(maze_passable[node]) and node not in blocked
+            edge_cost = float(1 + int(self.traffic_delay)*new_traffic.get(node, 0))
+            if passable != self._passable[node] or edge_cost != self._edge_costs[node]:
+                self._passable[node] = passable
+                self._edge_costs[node] = edge_cost
+                changed.append(node)
+        if self._cost_to_go is not None:
+            for node in changed:
+                self._update_node(node)
+        return changed
+
+    def dijkstra(self):
+        if self._cost_to_go is None:
+            self._cost_to_go = [float('inf')]*len(self._passable)
+            self._rhs = [float('inf')]*len(self._passable)
+            self._rhs[self._goal] = 0
+            heapq.heappush(self._heap, (0, self._goal))
+        self._compute()
+        return CostToGo(np.array(self._cost_to_go, dtype=float).reshape(self.maze_map.shape))
+
+
+class PlanCache:
+    """
+    Process-wide LRU cache of cost-to-go fields, content-addressed by the planning inputs
+    (maze, goal, accident, closure, traffic and traffic delay). Entries are evicted in least recently used
+    order once either max_entries or max_bytes is exceeded. Cached arrays are read-only since they are shared.
+    """
+
+    def __init__(self, max_entries=4096, max_bytes=64*2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self._entries = OrderedDict()
+        self.clear()
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    @staticmethod
+    def key(maze_map, goal_loc, accident_loc, closure_loc, traffic_locs, traffic_delay):
+        return (maze_map.key, tuple(goal_loc), tuple(accident_loc), tuple(closure_loc), \
+                tuple(tuple(traffic_loc) for traffic_loc in traffic_locs), int(traffic_delay))
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        cost_to_go = self._entries.get(key)
+        if cost_to_go is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return cost_to_go
+
+    def put(self, key, cost_to_go):
+        if not self.enabled:
+            return cost_to_go
+        cost_to_go.array.setflags(write=False)
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key).array.nbytes
+        self._entries[key] = cost_to_go
+        self.nbytes += cost_to_go.array.nbytes
+        while self._entries and (len(self._entries) > self.max_entries or self.nbytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= evicted.array.nbytes
+            self.evictions += 1
+        return cost_to_go
+
+    def plan(self, planner):
+        # run planner.dijkstra(), unless the same inputs have already been planned
+        key = self.key(planner.maze_map, planner.goal_loc, planner.accident_loc, planner.closure_loc, planner.traffic_locs, planner.traffic_delay)
+        cost_to_go = self.get(key)
+        if cost_to_go is None:
+            cost_to_go = self.put(key, planner.dijkstra())
+        return cost_to_go
+
+# shared by all plan() calls of the process, including the rollouts of the human simulations
+plan_cache = PlanCache()
+
+
+def traffic_key(traffic_locs):
+    # key of the cost-to-go fields of a traffic belief or hypothesis, i.e. str() of the traffic locations as lists
+    return str([list(traffic_loc) for traffic_loc in traffic_locs])
+
+def plan_traffic_states(maze_map, goal_loc, accident_loc, closure_loc, traffic_locs, traffic_delay, unknown_inds, traffic_states):
+    """
+    Flattened cost-to-go arrays of traffic_locs with the values of the spots at unknown_inds replaced by each
+    row of traffic_states (values can be fractional, i.e. expected costs). Cached rows are reused, the others
+    are planned in a single batched pass.
+    """
+    costs_to_go = [None]*len(traffic_states)
+    uncached = []
+    for row, traffic_state in enumerate(traffic_states):
+        # the rows only hold scalars, a copy of each row is enough
+        potential_traffic_locs = [list(traffic_loc) for traffic_loc in traffic_locs]
+        for col, ind in enumerate(unknown_inds):
+            potential_traffic_locs[ind][2] = traffic_state[col]
+        cache_key = plan_cache.key(maze_map, goal_loc, accident_loc, closure_loc, potential_traffic_locs, traffic_delay)
+        cost_to_go = plan_cache.get(cache_key)
+        if cost_to_go is None:
+            uncached.append((row, cache_key))
+        else:
+            costs_to_go[row] = cost_to_go.array.ravel()
+
+    if uncached:
+        planner = BatchedPlanner(maze_map, goal_loc, accident_loc, closure_loc, traffic_locs, traffic_delay, agent_name='ai')
+        batch_costs_to_go = planner.dijkstra_batch(unknown_inds, [traffic_states[row] for row, _ in uncached])
+        for (row, cache_key), cost_to_go in zip(uncached, batch_costs_to_go):
+            costs_to_go[row] = plan_cache.put(cache_key, CostToGo(cost_to_go)).array.ravel()
+    return np.stack(costs_to_go)
+
+
+class HypothesesCostsToGo(dict):
+    """
+    Cost-to-go fields of the hypotheses about the uncertain traffic spots (value not in {0.0, 1.0}) of
+    traffic_locs, keyed by traffic_key() of the traffic locations with the uncertain values set to 0.0 or 1.0.
+    A hypothesis is only planned the first time it is indexed. plan_hypotheses() plans all the
+    remaining hypotheses at once, for callers that need every one of them.
+    """
+
+    def __init__(self, maze_map, goal_loc, accident_loc, closure_loc, traffic_locs, traffic_delay):
+        super().__init__()
+        self.maze_map = maze_map
+        self.goal_loc = goal_loc
+        self.accident_loc = accident_loc
+        self.closure_loc = closure_loc
+        self.traffic_locs = [list(traffic_loc) for traffic_loc in traffic_locs]
+        self.traffic_delay = traffic_delay
+        self.unknown_inds = [ind for ind, loc in enumerate(self.traffic_locs) if loc[2] not in {0.0, 1.0}]
+
+    def _parse_hypothesis(self, key):
+        # recover the traffic locations from the key and check that they are a hypothesis of this belief
+        try:
+            traffic_locs = ast.literal_eval(key)
+        except (ValueError, SyntaxError):
+            return None
+        if not isinstance(traffic_locs, list) or len(traffic_locs) != len(self.traffic_locs):
+            return None
+        for ind, (loc, belief_loc) in enumerate(zip(traffic_locs, self.traffic_locs)):
+            if list(loc[:2]) != list(belief_loc[:2]):
+                return None
+            if ind in self.unknown_inds and loc[2] not in {0.0, 1.0}:
+                return None
+            if ind not in self.unknown_inds and loc[2] != belief_loc[2]:
+                return None
+        return traffic_locs
+
+    def __missing__(self, key):
+        traffic_locs = self._parse_hypothesis(key)
+        if traffic_locs is None:
+            raise KeyError(key)
+        planner = BucketPlanner(self.maze_map, self.goal_loc, self.accident_loc, self.closure_loc, traffic_locs, self.traffic_delay, agent_name='ai')
+        self[key] = plan_cache.plan(planner)
+        return self[key]
+
+    def hypotheses(self):
+        # all the hypotheses, in the order of product([0.0, 1.0], repeat=len(self.unknown_inds))
+        traffic_locs = copy.deepcopy(self.traffic_locs)
+        for state in product([0.0, 1.0], repeat=len(self.unknown_inds)):
+            for col, ind in enumerate(self.unknown_inds):
+                traffic_locs[ind][2] = state[col]
+            yield state, traffic_key(traffic_locs), copy.deepcopy(traffic_locs)
+
+    def plan_hypotheses(self):
+        # plan every hypothesis that has been neither indexed nor cached, in a single batched pass
+        uncached = []
+        for state, key, traffic_locs in self.hypotheses():
+            if dict.__contains__(self, key):
+                continue
+            cache_key = plan_cache.key(self.maze_map, self.goal_loc, self.accident_loc, self.closure_loc, traffic_locs, self.traffic_delay)
+            cost_to_go = plan_cache.get(cache_key)
+            if cost_to_go is None:
+                uncached.append((state, key, cache_key))
+            else:
+                self[key] = cost_to_go
+
+        if uncached:
+            planner = BatchedPlanner(self.maze_map, self.goal_loc, self.accident_loc, self.closure_loc, self.traffic_locs, self.traffic_delay, agent_name='ai')
+            hypotheses_costs_to_go = planner.dijkstra_batch(self.unknown_inds, [state for state, _, _ in uncached])
+            for (_, key, cache_key), hypothesis_cost_to_go in zip(uncached, hypotheses_costs_to_go):
+                self[key] = plan_cache.put(cache_key, CostToGo(hypothesis_cost_to_go))
+        return self
+
+    def stack(self):
+        # cost-to-go arrays of all the hypotheses, flattened and stacked in the order of hypotheses()
+        self.plan_hypotheses()
+        return np.stack([self[key].array.ravel() for _, key, _ in self.hypotheses()])
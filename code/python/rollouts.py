@@ -0,0 +1,391 @@
+import numpy as np
+from numpy.random import default_rng
+from itertools import product
+from planner import BucketPlanner, plan_cache
+
+class RolloutModel:
+    """
+    Array description of the simulated episodes of human_simulations, for one driver ('human' or 'ai').
+    As in human_simulations:
+        - accident and closure locations match the human's belief, not the true state
+        - traffic conditions are sampled from bernoullis based on the human's current belief
+        - the human drives with the human's belief, which is updated with the traffic spots in view
+        - the ai drives knowing the sampled traffic, and sees the accident and closure when they are in view
+        - both follow a softmax policy with scaler sim_scaler, and switching is disabled
+    The cost-to-go field of every belief reached by the rollouts is planned once, through the plan cache.
+    """
+
+    def __init__(self, maze_problem, agent_name):
+        state = maze_problem.env.state
+        human_belief = maze_problem.human_agent.belief
+        ai_belief = maze_problem.ai_agent.belief
+        self.agent_name = agent_name
+        self.maze_map = state.maze_map
+        self.goal_loc = state.goal_loc
+        self.goal = self.maze_map.index(state.goal_loc)
+        self.start = self.maze_map.index(state.vehicle_loc)
+        self.time_idle = state.time_idle
+        self.traffic_delay = maze_problem.traffic_delay
+        self.scaler = maze_problem.sim_scaler
+
+        # inside the simulation, the true accident and closure match the human's belief
+        self.accident_loc = human_belief.accident_loc
+        self.closure_loc = human_belief.closure_loc
+        self.blocked = np.array(self.maze_map.blocked_cells(self.accident_loc, self.closure_loc), dtype=int)
+        self.ai_accident_loc = ai_belief.accident_loc
+        self.ai_closure_loc = ai_belief.closure_loc
+        # any committed action is erased when the human takes over, and kept as is when the ai drives
+        self.committed_action = state.committed_action if agent_name == 'ai' else 'none'
+
+        self.traffic_locs = [[traffic_x, traffic_y] for traffic_x, traffic_y, _ in human_belief.traffic_locs]
+        self.traffic_probs = [traffic_prob for _, _, traffic_prob in human_belief.traffic_locs]
+        self.traffic_cells = np.array([self.maze_map.index(loc) for loc in self.traffic_locs], dtype=int)
+
+        # field of vision of every cell (see ObservationModel._is_in_field_of_vision)
+        rows, cols = np.divmod(self.maze_map.cells.ravel(), self.maze_map.shape[1])
+        def in_view(loc):
+            return (np.abs(rows - loc[0]) <= 1) & (np.abs(cols - loc[1]) <= 1)
+        self.spots_in_view = np.zeros((rows.size, len(self.traffic_locs)), dtype=bool)
+        for spot, loc in enumerate(self.traffic_locs):
+            self.spots_in_view[:, spot] = in_view(loc)
+        self.accident_in_view = in_view(self.accident_loc) if self.accident_loc[0] != -1 else np.zeros(rows.size, dtype=bool)
+        self.closure_in_view = in_view(self.closure_loc) if self.closure_loc[0] != -1 else np.zeros(rows.size, dtype=bool)
+
+        self._fields = []
+        self._field_ids = {}
+        self._stacked_fields = None
+
+    @property
+    def num_of_spots(self):
+        return len(self.traffic_locs)
+
+    def sample_traffic(self, rng, num_of_rollouts):
+        return (rng.random((num_of_rollouts, self.num_of_spots)) < np.array(self.traffic_probs, dtype=float)).astype(int)
+
+    def uncertain_spots(self):
+        traffic_probs = np.array(self.traffic_probs, dtype=float)
+        return np.nonzero((traffic_probs > 0) & (traffic_probs < 1))[0]
+
+    def traffic_configurations(self):
+        # every traffic configuration that can be sampled, with its prior probability
+        traffic_probs = np.array(self.traffic_probs, dtype=float)
+        uncertain = self.uncertain_spots()
+        traffic = np.tile((traffic_probs >= 1).astype(int), (2**len(uncertain), 1))
+        traffic[:, uncertain] = np.array(list(product([0, 1], repeat=len(uncertain))), dtype=int, ndmin=2)
+        priors = np.prod(np.where(traffic == 1, traffic_probs, 1-traffic_probs), axis=1)
+        return traffic, priors
+
+    def initial_knowledge(self, traffic):
+        # what the driver knows after the first observation, at the start of every rollout
+        num_of_rollouts = traffic.shape[0]
+        revealed = np.tile(self.spots_in_view[self.start], (num_of_rollouts, 1))
+        # traffic spots the human is already certain about are known
+        revealed |= np.isin(np.array(self.traffic_probs, dtype=float), [0.0, 1.0])[None, :]
+        accident_seen = np.full(num_of_rollouts, self.accident_in_view[self.start])
+        closure_seen = np.full(num_of_rollouts, self.closure_in_view[self.start])
+        return revealed, accident_seen, closure_seen
+
+    def _plan(self, traffic, revealed, accident_seen, closure_seen):
+        if self.agent_name == 'human':
+            traffic_locs = [[loc[0], loc[1], float(traffic[spot]) if revealed[spot] else self.traffic_probs[spot]] for spot, loc in enumerate(self.traffic_locs)]
+            planner = BucketPlanner(self.maze_map, self.goal_loc, self.accident_loc, self.closure_loc, traffic_locs, self.traffic_delay, agent_name='human')
+        else:
+            traffic_locs = [[loc[0], loc[1], int(traffic[spot])] for spot, loc in enumerate(self.traffic_locs)]
+            accident_loc = self.accident_loc if accident_seen else self.ai_accident_loc
+            closure_loc = self.closure_loc if closure_seen else self.ai_closure_loc
+            planner = BucketPlanner(self.maze_map, self.goal_loc, accident_loc, closure_loc, traffic_locs, self.traffic_delay, agent_name='ai')
+        return plan_cache.plan(planner).array.ravel()
+
+    def _belief_rows(self, traffic, revealed, accident_seen, closure_seen):
+        # one row per rollout, identifying the belief the driver plans with
+        if self.agent_name == 'human':
+            return np.where(revealed, traffic+1, 0)
+        return np.column_stack([traffic, accident_seen, closure_seen])
+
+    def field_ids(self, traffic, revealed, accident_seen, closure_seen):
+        rows = self._belief_rows(traffic, revealed, accident_seen, closure_seen).astype(np.int8)
+        unique_rows, first, inverse = np.unique(rows, axis=0, return_index=True, return_inverse=True)
+        ids = np.empty(len(unique_rows), dtype=int)
+        for ind, (row, rollout) in enumerate(zip(unique_rows, first)):
+            key = row.tobytes()
+            if key not in self._field_ids:
+                self._field_ids[key] = len(self._fields)
+                self._fields.append(self._plan(traffic[rollout], revealed[rollout], accident_seen[rollout], closure_seen[rollout]))
+                self._stacked_fields = None
+            ids[ind] = self._field_ids[key]
+        return ids[inverse.ravel()]
+
+    def fields(self):
+        if self._stacked_fields is None:
+            self._stacked_fields = np.stack(self._fields)
+        return self._stacked_fields
+
+    def action_probabilities(self, fields, cells):
+        # softmax over the cost-to-go of the reachable neighbors, in 'r', 'l', 'u', 'd' order (see PolicyModel)
+        next_cells = self.maze_map.next_cells[cells]
+        neighbor_costs = np.where(next_cells >= 0, np.take_along_axis(fields, np.maximum(next_cells, 0), axis=1), np.inf)
+        logits = -self.scaler*neighbor_costs
+        logits -= np.max(logits, axis=1, keepdims=True)
+        scores = np.exp(logits)
+        return scores / np.sum(scores, axis=1, keepdims=True)
+
+    def step(self, traffic, cells, time_idle, actions):
+        # see TransitionModel.get_next_state
+        at_traffic = (self.traffic_cells[None, :] == cells[:, None]) & (traffic == 1)
+        stuck = np.any(at_traffic, axis=1) & (time_idle < self.traffic_delay)
+        next_cells = self.maze_map.next_cells[cells, actions]
+        blocked = (next_cells < 0) | ~self.maze_map.passable.ravel()[np.maximum(next_cells, 0)] | np.isin(next_cells, self.blocked)
+        move = ~stuck & ~blocked
+        return np.where(move, next_cells, cells), np.where(move, 0, time_idle+1)
+
+
+def sample_actions(probabilities, uniforms):
+    # inverse-cdf sampling, as done by Generator.choice
+    cdf = np.cumsum(probabilities, axis=1)
+    cdf /= cdf[:, -1:]
+    actions = np.sum(cdf <= uniforms[:, None], axis=1)
+    last_valid = probabilities.shape[1] - 1 - np.argmax(probabilities[:, ::-1] > 0, axis=1)
+    return np.minimum(actions, last_valid)
+
+def run_rollouts(model, rng, num_of_rollouts=None, traffic=None, common_random_numbers=False):
+    """
+    Simulates all the rollouts of a RolloutModel in lockstep and returns their completion times,
+    i.e. the number of time steps needed to reach the goal. Traffic conditions are sampled from the
+    human's belief, unless a (rollouts, traffic spots) array of traffic conditions is given.
+    With common random numbers, every rollout draws its uniform of every time step, whether it is still active or not.
+    """
+    if traffic is None:
+        traffic = model.sample_traffic(rng, num_of_rollouts)
+    traffic = np.asarray(traffic, dtype=int).reshape(-1, model.num_of_spots)
+    num_of_rollouts = traffic.shape[0]
+
+    cells = np.full(num_of_rollouts, model.start, dtype=int)
+    time_idle = np.full(num_of_rollouts, model.time_idle, dtype=int)
+    revealed, accident_seen, closure_seen = model.initial_knowledge(traffic)
+    completion_times = np.zeros(num_of_rollouts, dtype=int)
+    active = cells != model.goal
+
+    t = 0
+    while np.any(active):
+        idx = np.nonzero(active)[0]
+        field_ids = model.field_ids(traffic[idx], revealed[idx], accident_seen[idx], closure_seen[idx])
+        fields = model.fields()[field_ids]
+
+        if t == 0 and model.committed_action != 'none':
+            # the committed action applies, whatever the plan
+            actions = np.full(len(idx), model.maze_map.ACTION_INDEX[model.committed_action])
+        else:
+            # no feasible plan from the current cell: terminate early, as in simulate()
+            feasible = fields[np.arange(len(idx)), cells[idx]] != np.inf
+            completion_times[idx[~feasible]] = t-1
+            active[idx[~feasible]] = False
+            idx, fields = idx[feasible], fields[feasible]
+            if len(idx) == 0:
+                break
+            uniforms = rng.random(num_of_rollouts)[idx] if common_random_numbers else rng.random(len(idx))
+            actions = sample_actions(model.action_probabilities(fields, cells[idx]), uniforms)
+
+        cells[idx], time_idle[idx] = model.step(traffic[idx], cells[idx], time_idle[idx], actions)
+
+        # observe the surroundings of the new cell
+        revealed[idx] |= model.spots_in_view[cells[idx]]
+        accident_seen[idx] |= model.accident_in_view[cells[idx]]
+        closure_seen[idx] |= model.closure_in_view[cells[idx]]
+
+        t += 1
+        arrived = idx[cells[idx] == model.goal]
+        completion_times[arrived] = t
+        active[arrived] = False
+
+    return completion_times
+
+def completion_time_distribution(model, traffic, priors, horizon=None, tolerance=1e-12, max_steps=10000):
+    """
+    Exact distribution of the completion times of a RolloutModel, given traffic configurations and their
+    probabilities. Instead of sampling rollouts, the probability mass is propagated forward over the
+    (traffic, cell, time_idle, driver's knowledge) states, following every action of the softmax policy.
+    With a horizon, the probability of completing after the horizon is assigned to horizon+1; without one,
+    the propagation stops when the remaining probability mass falls below tolerance.
+    Returns the completion times and their probabilities.
+    """
+    traffic = np.asarray(traffic, dtype=int).reshape(-1, model.num_of_spots)
+    probs = np.asarray(priors, dtype=float)
+    num_of_states = traffic.shape[0]
+
+    cells = np.full(num_of_states, model.start, dtype=int)
+    time_idle = np.full(num_of_states, model.time_idle, dtype=int)
+    revealed, accident_seen, closure_seen = model.initial_knowledge(traffic)
+    distribution = {}
+    def settle(mask, completion_time):
+        if np.any(mask):
+            distribution[completion_time] = distribution.get(completion_time, 0.0) + np.sum(probs[mask])
+
+    settle(cells == model.goal, 0)
+    keep = cells != model.goal
+    traffic, probs, cells, time_idle, revealed, accident_seen, closure_seen = traffic[keep], probs[keep], cells[keep], time_idle[keep], revealed[keep], accident_seen[keep], closure_seen[keep]
+
+    t = 0
+    while len(probs) > 0:
+        if horizon is not None and t > horizon:
+            settle(np.ones(len(probs), dtype=bool), horizon+1)
+            break
+        if horizon is None and (np.sum(probs) < tolerance or t >= max_steps):
+            settle(np.ones(len(probs), dtype=bool), t)
+            break
+
+        field_ids = model.field_ids(traffic, revealed, accident_seen, closure_seen)
+        fields = model.fields()[field_ids]
+        if t == 0 and model.committed_action != 'none':
+            # the committed action applies, whatever the plan
+            states = np.arange(len(probs))
+            actions = np.full(len(probs), model.maze_map.ACTION_INDEX[model.committed_action])
+        else:
+            # no feasible plan from the current cell: terminate early, as in simulate()
+            feasible = fields[np.arange(len(probs)), cells] != np.inf
+            settle(~feasible, t-1)
+            # branch on every action with non-zero probability
+            action_probs = np.zeros((len(probs), len(model.maze_map.ACTIONS)))
+            action_probs[feasible] = model.action_probabilities(fields[feasible], cells[feasible])
+            states, actions = np.nonzero(action_probs)
+            probs = probs[states] * action_probs[states, actions]
+
+        traffic, time_idle, revealed, accident_seen, closure_seen = traffic[states], time_idle[states], revealed[states], accident_seen[states], closure_seen[states]
+        cells, time_idle = model.step(traffic, cells[states], time_idle, actions)
+        revealed |= model.spots_in_view[cells]
+        accident_seen |= model.accident_in_view[cells]
+        closure_seen |= model.closure_in_view[cells]
+
+        t += 1
+        arrived = cells == model.goal
+        settle(arrived, t)
+
+        # merge the states that only differ in the way they were reached
+        keys = np.column_stack([traffic, cells, time_idle, model._belief_rows(traffic, revealed, accident_seen, closure_seen)])[~arrived]
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        probs = np.bincount(inverse.ravel(), weights=probs[~arrived])
+        states = np.nonzero(~arrived)[0][first]
+        traffic, cells, time_idle, revealed, accident_seen, closure_seen = traffic[states], cells[states], time_idle[states], revealed[states], accident_seen[states], closure_seen[states]
+
+    completion_times = sorted(distribution)
+    return np.array(completion_times, dtype=int), np.array([distribution[completion_time] for completion_time in completion_times])
+
+def shift_completion_times(maze_problem, ai_completion_times, human_completion_times):
+
+    # NOTE: adding +1 to the completion times if the driver changes
+    # because the simulated episodes start one time step later
+    if maze_problem.env.state.agent_name == 'ai':
+        human_completion_times = [t+1 for t in human_completion_times]
+    if maze_problem.env.state.agent_name == 'human':
+        ai_completion_times = [t+1 for t in ai_completion_times]
+    return ai_completion_times, human_completion_times
+
+def completion_scores(maze_problem, ai_completion_times, human_completion_times, time_remaining=None, ai_weights=None, human_weights=None):
+
+    ai_completion_times, human_completion_times = shift_completion_times(maze_problem, ai_completion_times, human_completion_times)
+
+    # completion times can be weighted by their probabilities (e.g., exact distributions)
+    if time_remaining is None:
+        # set AI and human scores as the negative average completion times
+        ai_score = - np.average(ai_completion_times, weights=ai_weights)
+        human_score = - np.average(human_completion_times, weights=human_weights)
+    else:
+        # set AI and human scores as the probability of reaching the goal within the horizon
+        ai_score = np.average(np.array(ai_completion_times) <= time_remaining, weights=ai_weights)
+        human_score = np.average(np.array(human_completion_times) <= time_remaining, weights=human_weights)
+
+    return ai_score, human_score
+
+def vectorized_human_simulations(maze_problem, rng_agent, num_of_seeds=10, time_remaining=None, common_random_numbers=False):
+    # same estimates as human_simulations, with all the rollouts of each driver simulated in lockstep
+    if common_random_numbers:
+        # the rollouts of both drivers share their traffic conditions and uniforms, rollout by rollout
+        human_model = RolloutModel(maze_problem, 'human')
+        traffic = human_model.sample_traffic(rng_agent, num_of_seeds)
+        seed = rng_agent.integers(2**63)
+        human_completion_times = run_rollouts(human_model, default_rng(seed), traffic=traffic, common_random_numbers=True)
+        ai_completion_times = run_rollouts(RolloutModel(maze_problem, 'ai'), default_rng(seed), traffic=traffic, common_random_numbers=True)
+        return completion_scores(maze_problem, ai_completion_times, human_completion_times, time_remaining)
+    human_completion_times = run_rollouts(RolloutModel(maze_problem, 'human'), rng_agent, num_of_seeds)
+    ai_completion_times = run_rollouts(RolloutModel(maze_problem, 'ai'), rng_agent, num_of_seeds)
+    return completion_scores(maze_problem, ai_completion_times, human_completion_times, time_remaining)
+
+def exact_human_simulations(maze_problem, rng_agent=None, num_of_seeds=None, time_remaining=None):
+    # same scores as human_simulations, computed from the exact completion time distributions instead of sampled rollouts
+    distributions = {}
+    for agent_name in ['human', 'ai']:
+        model = RolloutModel(maze_problem, agent_name)
+        traffic, priors = model.traffic_configurations()
+        distributions[agent_name] = completion_time_distribution(model, traffic, priors, horizon=time_remaining)
+    ai_completion_times, ai_probs = distributions['ai']
+    human_completion_times, human_probs = distributions['human']
+    return completion_scores(maze_problem, ai_completion_times, human_completion_times, time_remaining, ai_weights=ai_probs, human_weights=human_probs)
+
+def score_standard_error(completion_times, time_remaining=None):
+    # completion_times are shifted as in completion_scores, so that the successes are the ones of the scores
+    completion_times = np.asarray(completion_times)
+    if time_remaining is None:
+        return np.std(completion_times, ddof=1) / np.sqrt(len(completion_times))
+    # add two successes and two failures (Agresti-Coull), so that batches where all the rollouts
+    # succeed or fail do not look certain
+    successes = np.sum(completion_times <= time_remaining)
+    success_prob = (successes + 2) / (len(completion_times) + 4)
+    return np.sqrt(success_prob * (1-success_prob) / (len(completion_times) + 4))
+
+def adaptive_human_simulations(maze_problem, rng_agent, num_of_seeds=300, time_remaining=None, tolerance=0.01, batch_size=50, z_score=1.96):
+    """
+    Lockstep human simulations run in batches, stopping as soon as the probability of the human taking over
+    (softmax of the scores with scaler sim_scaler, as in simulate) is known within +/- tolerance, at the
+    confidence level given by z_score, or when num_of_seeds rollouts per driver have been used.
+    Returns the ai and human scores, and the total number of rollouts used.
+    """
+    models = {agent_name: RolloutModel(maze_problem, agent_name) for agent_name in ['human', 'ai']}
+    completion_times = {'human': [], 'ai': []}
+    num_of_rollouts = 0
+    while num_of_rollouts < num_of_seeds:
+        batch = min(batch_size, num_of_seeds-num_of_rollouts)
+        for agent_name in ['human', 'ai']:
+            completion_times[agent_name].append(run_rollouts(models[agent_name], rng_agent, batch))
+        num_of_rollouts += batch
+
+        if num_of_rollouts > 1:
+            ai_score, human_score = completion_scores(maze_problem, np.concatenate(completion_times['ai']), np.concatenate(completion_times['human']), time_remaining)
+            # confidence interval of the difference between the scores, mapped through the softmax
+            ai_completion_times, human_completion_times = shift_completion_times(maze_problem, np.concatenate(completion_times['ai']), np.concatenate(completion_times['human']))
+            score_error = z_score * np.sqrt(score_standard_error(ai_completion_times, time_remaining)**2 + score_standard_error(human_completion_times, time_remaining)**2)
+            takeover_probs = 1 / (1 + np.exp(-maze_problem.sim_scaler * (human_score - ai_score + np.array([-score_error, score_error]))))
+            if np.abs(takeover_probs[1] - takeover_probs[0]) / 2 <= tolerance:
+                break
+
+    ai_score, human_score = completion_scores(maze_problem, np.concatenate(completion_times['ai']), np.concatenate(completion_times['human']), time_remaining)
+    return ai_score, human_score, 2*num_of_rollouts
+
+def stratified_human_simulations(maze_problem, rng_agent, num_of_seeds=10, time_remaining=None, rao_blackwellize=False):
+    """
+    Lockstep human simulations grouped by traffic configuration. The number of rollouts of every configuration
+    is drawn first (multinomial over the configurations' prior probabilities), then the rollouts of each
+    configuration are simulated together, with its cost-to-go fields planned once. With rao_blackwellize, the
+    configurations are not sampled: every configuration gets rollouts in proportion to its prior (at least one)
+    and is weighted by its exact prior probability. When there are more configurations than num_of_seeds, they are
+    neither enumerated nor rao-blackwellized: the configurations of the rollouts are drawn from the priors and grouped.
+    Returns the ai and human scores, and the total number of rollouts used.
+    """
+    models = {agent_name: RolloutModel(maze_problem, agent_name) for agent_name in ['human', 'ai']}
+    # both drivers face the same configurations, with the same prior probabilities
+    if 2**len(models['human'].uncertain_spots()) > num_of_seeds:
+        # same distribution of the counts as the multinomial, and at least one rollout per configuration would exceed the budget
+        traffic, counts = np.unique(models['human'].sample_traffic(rng_agent, num_of_seeds), axis=0, return_counts=True)
+        weights = None
+    elif rao_blackwellize:
+        traffic, priors = models['human'].traffic_configurations()
+        counts = np.maximum(1, np.floor(num_of_seeds*priors)).astype(int)
+        weights = np.repeat(priors/counts, counts)
+    else:
+        traffic, priors = models['human'].traffic_configurations()
+        counts = rng_agent.multinomial(num_of_seeds, priors/np.sum(priors))
+        weights = None
+    traffic = np.repeat(traffic, counts, axis=0)
+
+    human_completion_times = run_rollouts(models['human'], rng_agent, traffic=traffic)
+    ai_completion_times = run_rollouts(models['ai'], rng_agent, traffic=traffic)
+    ai_score, human_score = completion_scores(maze_problem, ai_completion_times, human_completion_times, time_remaining, ai_weights=weights, human_weights=weights)
+    return ai_score, human_score, 2*int(np.sum(counts))
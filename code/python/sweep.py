@@ -0,0 +1,177 @@
+import click
+import copy
+import json
+import os
+import pickle as pkl
+from multiprocessing import Pool
+from utils import available_cores, counterfactual_responses
+from maze_problem import MazeProblem, plan
+from batch_runner import load_world, report_episodes
+
+# Grid search of the counterfactual simulations on a local process pool, in place of one slurm job per
+# (world, scaler) pair (grid_counterfactual_*_slurm.sh). Every grid point writes the same report files as the
+# generate_counterfactual_*_slurm.sh scripts. The worlds are parsed and their initial beliefs planned before the
+# workers start, so that the workers share them, and the workers keep their planning caches from one grid point
+# to the next. Finished grid points are recorded in a checkpoint file, a resumed sweep skips them; the checkpoint also
+# records the settings of the sweep, and a sweep with other settings refuses to resume from it.
+# With common random numbers, the episodes of a seed draw the same uniforms at every grid point (see common_random_stream
+# in maze_problem.py), so the differences between neighboring scalers are not buried in the noise of independent draws.
+
+WORLD_ORDER = ['world43', 'world44', 'world45', 'world46', 'world47', 'world48', 'world57', 'world58', 'world49', 'world50', 'world55', 'world56', 'world51', 'world52', 'world53', 'world54']
+TRIAL_ORDER = ['trial1', 'trial2', 'trial3', 'trial4', 'trial5', 'trial6', 'trial7', 'trial8', 'trial9', 'trial10', 'trial11', 'trial12', 'trial13', 'trial14', 'trial15', 'trial16']
+SCALERS = [0.6, 0.8, 1.0, 1.2, 1.4, 1.6, 1.8, 2.0]
+
+def grid_points(experiments, worlds, trials, scalers):
+    # grid points in world-major order, so that consecutive points share their planning
+    return [{'experiment': experiment, 'world': world, 'trial': trial, 'scaler': scaler} \
+            for world, trial in zip(worlds, trials) for experiment in experiments for scaler in scalers]
+
+def point_name(point):
+    return '%s:%s_trial:%s_scaler:%s' % (point['experiment'], point['world'], point['trial'], point['scaler'])
+
+def world_file(settings, world):
+    return os.path.join(settings['world_directory'], world + '.txt')
+
+def episode_directory(settings, world):
+    return os.path.join(settings['log_directory'], world)
+
+def responses_file(settings, world, trial, answer):
+    return os.path.join(episode_directory(settings, world), 'counterfactual_responses:%s_explanation:%s_answer:%s.pkl' % (world, trial, answer))
+
+def run_grid_point(args):
+    """
+    Runs the counterfactual simulations of one grid point and returns its reports, by file
+    """
+    point, settings, rollout_workers = args
+    world, scaler = point['world'], point['scaler']
+    directory = episode_directory(settings, world)
+    seeds = range(1, settings['agent_seeds']+1)
+    params = {'traffic_delay': settings['traffic_delay'], 'radius': settings['radius'], 'ai_switching': 0.0, 'human_switching': 0.0, \
+              'human_scaler': scaler, 'ai_scaler': scaler, 'human_simulation_mode': settings['human_simulation_mode'], \
+              'common_random_numbers': settings['common_random_numbers'], 'num_of_workers': rollout_workers}
+
+    reports = {}
+    if point['experiment'] == 'episodes':
+        # the human drives on their own
+        params['initial_agent'] = settings['initial_agent']
+        report = report_episodes(world_file(settings, world), seeds, params, time_remaining=settings['time_remaining'])
+        reports[os.path.join(directory, 'cfreport:%s_humanscaler:%s_aiscaler:%s.json' % (world, scaler, scaler))] = report.to_dict()
+    else:
+        # the factual episode up to the switching decision, followed by the other decision
+        params.update({'sim_scaler': scaler, 'override': True, 'semi_manual_seed': settings['semi_manual_seed'], 'horizon': settings['time_remaining'], \
+                       'human_prob_estimates_file': os.path.join(directory, 'humanprobs:%s_simscaler:%s_semimanualseed:%d.json' % (world, scaler, settings['semi_manual_seed']))})
+        for answer in ['yes', 'no']:
+            report = report_episodes(world_file(settings, world), seeds, dict(params, responses_file=responses_file(settings, world, point['trial'], answer)))
+            reports[os.path.join(directory, 'cf%sreport:%s_humanscaler:%s_aiscaler:%s.json' % (answer, world, scaler, scaler))] = report.to_dict()
+
+    return point, reports
+
+def write_responses_files(points, settings):
+    # the counterfactual responses (yes and no) of the decisions, derived from the responses of the factual episode
+    for world, trial in sorted(set((point['world'], point['trial']) for point in points if point['experiment'] == 'decisions')):
+        with open(os.path.join(episode_directory(settings, world), 'factual_responses:%s_explanation:%s.pkl' % (world, trial)), 'rb') as f:
+            responses = pkl.load(f)
+        for yn, answer in [('y', 'yes'), ('n', 'no')]:
+            with open(responses_file(settings, world, trial, answer), 'wb') as f:
+                pkl.dump(counterfactual_responses(responses, yn), f)
+
+def warm_up(points, settings):
+    # parse the worlds and plan their initial beliefs, which do not depend on the scalers
+    for world in sorted(set(point['world'] for point in points)):
+        for initial_agent in ['ai', 'human']:
+            init_true_state = load_world(world_file(settings, world), initial_agent)
+            maze_problem = MazeProblem.create(init_true_state=copy.deepcopy(init_true_state), agent_seed=0, traffic_delay=settings['traffic_delay'], radius=settings['radius'])
+            costs_to_go = plan(maze_problem)
+            costs_to_go['human'].plan_hypotheses()
+
+def read_checkpoint(checkpoint_file, settings):
+    if checkpoint_file is None or not os.path.exists(checkpoint_file):
+        return []
+    with open(checkpoint_file, 'r') as f:
+        checkpoint = json.load(f)
+    # the reports of the finished grid points only stand for the settings they were run with
+    if checkpoint.get('settings') != json.loads(json.dumps(settings)):
+        raise ValueError('The checkpoint %s was written by a sweep with other settings (%s), remove it or use another checkpoint file' \
+                         % (checkpoint_file, checkpoint.get('settings')))
+    return checkpoint['finished']
+
+def write_checkpoint(checkpoint_file, finished, settings):
+    # written to a temporary file first, so that an interrupted sweep never leaves a broken checkpoint
+    with open(checkpoint_file + '.tmp', 'w') as f:
+        json.dump({'settings': settings, 'finished': finished}, f)
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+def run_sweep(points, settings, num_of_workers=None, checkpoint_file=None, verbose=0):
+    """
+    Runs the grid points that are not finished yet on num_of_workers processes (default: all cores),
+    writes their report files and records them in the checkpoint file as they finish
+    """
+    finished = read_checkpoint(checkpoint_file, settings)
+    pending = [point for point in points if point_name(point) not in finished]
+    if verbose > 0:
+        print('%d grid points, %d already finished' % (len(points), len(points)-len(pending)))
+    if not pending:
+        return
+
+    # shared with the workers, which are forked after the warm up
+    write_responses_files(pending, settings)
+    warm_up(pending, settings)
+    if num_of_workers is None:
+        num_of_workers = available_cores()
+    # the workers of the pool are daemonic and cannot start the pool of the parallel human simulations,
+    # which then run their rollouts in the worker itself
+    rollout_workers = 1 if num_of_workers > 1 else None
+
+    def record(point, reports):
+        for report_file, report in reports.items():
+            with open(report_file, 'w') as f:
+                json.dump(report, f)
+        finished.append(point_name(point))
+        if checkpoint_file is not None:
+            write_checkpoint(checkpoint_file, finished, settings)
+        if verbose > 0:
+            print('Finished %s (%d/%d)' % (point_name(point), len(finished), len(points)))
+
+    tasks = [(point, settings, rollout_workers) for point in pending]
+    if num_of_workers > 1:
+        with Pool(num_of_workers) as pool:
+            for point, reports in pool.imap_unordered(run_grid_point, tasks):
+                record(point, reports)
+    else:
+        for task in tasks:
+            record(*run_grid_point(task))
+
+@click.command()
+@click.option('--experiments', type=click.Choice(['episodes', 'decisions']), multiple=True, default=['episodes', 'decisions'], help='Counterfactual simulations to run: the human driving on their own (episodes) and/or the other switching decision (decisions)')
+@click.option('--worlds', type=str, default=','.join(WORLD_ORDER), help='Comma separated worlds of the grid')
+@click.option('--trials', type=str, default=','.join(TRIAL_ORDER), help='Comma separated trials of the worlds, in the same order')
+@click.option('--scalers', type=str, default=','.join(str(scaler) for scaler in SCALERS), help='Comma separated scalers of the grid (human, ai and simulation scalers)')
+@click.option('--log_directory', type=str, default='./resources/episodes/', help='Directory with the episodes of every world, where the reports are stored')
+@click.option('--world_directory', type=str, default='./resources/worlds/', help='Directory with the world files')
+@click.option('--agent_seeds', type=int, default=300, help='Number of counterfactual simulations per grid point')
+@click.option('--time_remaining', type=int, default=20, help='Time remaining cutoff of the successes (and horizon of the counterfactual decisions)')
+@click.option('--semi_manual_seed', type=int, default=42, help='Seed for the factual part of the counterfactual decisions')
+@click.option('--initial_agent', type=str, default='human', help="Initial agent of the counterfactual episodes ('ai' or 'human')")
+@click.option('--traffic_delay', type=int, default=10, help='Time penalty for crossing a traffic location')
+@click.option('--radius', type=int, default=1, help='The radius of the rectangular field of view')
+@click.option('--human_simulation_mode', type=click.Choice(['sequential', 'vectorized', 'parallel', 'exact', 'adaptive', 'stratified']), default='sequential', help='How the human simulations behind the switching decisions are run')
+@click.option('--common_random_numbers', is_flag=True, default=False, help='If true, the grid points share their random draws seed by seed, for smoother curves over the scalers with fewer seeds')
+@click.option('--num_of_workers', type=int, default=None, help='Number of processes running grid points (default: all cores); with more than one, the parallel human simulations of a grid point run in its process')
+@click.option('--checkpoint_file', type=str, default=None, help='File recording the finished grid points (default: sweep_checkpoint.json in the log directory)')
+@click.option('--verbose', type=click.Choice(['0', '1']), default='1', help='Select level of verbosity')
+def sweep(experiments, worlds, trials, scalers, log_directory, world_directory, agent_seeds, time_remaining, semi_manual_seed, initial_agent, traffic_delay, radius, \
+          human_simulation_mode, common_random_numbers, num_of_workers, checkpoint_file, verbose):
+
+    worlds, trials = worlds.split(','), trials.split(',')
+    if len(worlds) != len(trials):
+        raise click.UsageError('--worlds and --trials must have the same length')
+    if checkpoint_file is None:
+        checkpoint_file = os.path.join(log_directory, 'sweep_checkpoint.json')
+    settings = {'log_directory': log_directory, 'world_directory': world_directory, 'agent_seeds': agent_seeds, 'time_remaining': time_remaining, \
+                'semi_manual_seed': semi_manual_seed, 'initial_agent': initial_agent, 'traffic_delay': traffic_delay, 'radius': radius, \
+                'human_simulation_mode': human_simulation_mode, 'common_random_numbers': common_random_numbers}
+    points = grid_points(experiments, worlds, trials, [float(scaler) for scaler in scalers.split(',')])
+    run_sweep(points, settings, num_of_workers=num_of_workers, checkpoint_file=checkpoint_file, verbose=int(verbose))
+
+if __name__ == '__main__':
+    sweep()
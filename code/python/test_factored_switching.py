@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from numpy.random import default_rng
+
+from domain import MazeState
+from maze_problem import MazeProblem, estimate_human_scores, run_episode
+from utils import parse_initial_state
+
+# 8x8 world with 26 traffic spots, far more than the exact bayesian update can enumerate
+WORLD = ['- - - t - - - g',
+         '- t - t - t - -',
+         't - t - t - t -',
+         '- t - T - t - t',
+         't - t - t - T -',
+         '- T - t - t - t',
+         't - t - T - t -',
+         'v - - t - - t -']
+
+@pytest.fixture
+def init_true_state(tmp_path):
+    world_file = tmp_path / 'world.txt'
+    world_file.write_text('\n'.join(WORLD))
+    return MazeState(*parse_initial_state(str(world_file), 'ai'))
+
+def uncertain_spots(maze_problem):
+    return sum(0.0 < traffic_prob < 1.0 for _, _, traffic_prob in maze_problem.human_agent.belief.traffic_locs)
+
+@pytest.mark.parametrize('human_simulation_mode', ['sequential', 'parallel'])
+def test_switching_rollouts_use_factored_belief(init_true_state, human_simulation_mode):
+    # the rollouts of the switching decision update the simulated human's belief as well,
+    # with the exact update they would enumerate 2^25 hypotheses at every ai step
+    maze_problem = MazeProblem.create(init_true_state=init_true_state, agent_seed=3, ai_switching=1.0, human_switching=1.0)
+    assert uncertain_spots(maze_problem) > 20
+    ai_score, human_score, num_of_rollouts = estimate_human_scores(maze_problem, default_rng(0), num_of_seeds=3, human_simulation_mode=human_simulation_mode, \
+                                                                   num_of_workers=1, belief_mode='factored', max_hypotheses=16)
+    assert num_of_rollouts == 6
+    assert np.isfinite(ai_score) and np.isfinite(human_score)
+
+def test_exact_simulations_reject_factored_belief(init_true_state):
+    maze_problem = MazeProblem.create(init_true_state=init_true_state, agent_seed=3, ai_switching=1.0, human_switching=1.0)
+    with pytest.raises(ValueError):
+        estimate_human_scores(maze_problem, default_rng(0), num_of_seeds=3, human_simulation_mode='exact', belief_mode='factored', max_hypotheses=16)
+
+@pytest.mark.parametrize('rao_blackwellize', [False, True])
+def test_stratified_simulations_keep_their_budget(init_true_state, rao_blackwellize):
+    # 2^25 traffic configurations, far more than the rollouts
+    maze_problem = MazeProblem.create(init_true_state=init_true_state, agent_seed=3, ai_switching=1.0, human_switching=1.0)
+    _, _, num_of_rollouts = estimate_human_scores(maze_problem, default_rng(0), num_of_seeds=10, human_simulation_mode='stratified', \
+                                                  rao_blackwellize=rao_blackwellize, belief_mode='factored', max_hypotheses=16)
+    assert num_of_rollouts == 20
+
+def test_switching_episode_with_factored_belief(init_true_state):
+    logs, _ = run_episode(init_true_state, agent_seed=3, ai_switching=1.0, human_switching=1.0, human_simulation_mode='vectorized', \
+                          belief_mode='factored', max_hypotheses=16, log_level='summary')
+    assert logs['success']
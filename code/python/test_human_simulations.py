@@ -0,0 +1,27 @@
+import pytest
+from numpy.random import default_rng
+
+from domain import MazeState
+from maze_problem import MazeProblem, estimate_human_scores
+from utils import parse_initial_state
+
+# 4x4 world with 3 traffic spots, small enough for the exact solver
+WORLD = ['- - t g',
+         '- t - -',
+         '- - - t',
+         'v - - -']
+
+@pytest.fixture
+def maze_problem(tmp_path):
+    world_file = tmp_path / 'world.txt'
+    world_file.write_text('\n'.join(WORLD))
+    init_true_state = MazeState(*parse_initial_state(str(world_file), 'ai'))
+    return MazeProblem.create(init_true_state=init_true_state, agent_seed=3, ai_switching=1.0, human_switching=1.0)
+
+def test_vectorized_simulations_match_exact_solver(maze_problem):
+    exact_ai_score, exact_human_score, _ = estimate_human_scores(maze_problem, default_rng(0), human_simulation_mode='exact')
+    ai_score, human_score, num_of_rollouts = estimate_human_scores(maze_problem, default_rng(0), num_of_seeds=2000, human_simulation_mode='vectorized')
+    assert num_of_rollouts == 4000
+    # the standard deviation of the sampled scores is about 0.06 with 2000 rollouts per driver
+    assert ai_score == pytest.approx(exact_ai_score, abs=0.3)
+    assert human_score == pytest.approx(exact_human_score, abs=0.3)
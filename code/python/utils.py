@@ -1,8 +1,10 @@
 import matplotlib.pyplot as plt
 import matplotlib
 import numpy as np
+import os
 import pickle
 import click
+from domain import MazeMap
 
 def parse_initial_state(world_file, initial_agent):
 
@@ -49,6 +51,9 @@ def parse_initial_state(world_file, initial_agent):
     # initialize time_idle to 0 and get agent_name
     time_idle = 0
 
+    # compile the map, once every marker has been replaced by a road
+    maze_map = MazeMap.from_chars(maze_map)
+
     return maze_map, vehicle_loc, goal_loc, closure_loc, accident_loc, traffic_locs, time_idle, initial_agent
 
 def get_fig_dim(width, fraction=1, aspect_ratio=None):
@@ -132,6 +137,25 @@ def latexify(font_serif='Computer Modern', mathtext_font='cm', font_size=10, sma
     matplotlib.rcParams.update(params)
     plt.rcParams.update(params)
 
+def available_cores():
+    # cores available to this process (e.g., the ones allocated by slurm), or all the cores where the
+    # affinity of a process is not exposed (macOS and Windows)
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+def counterfactual_responses(responses, yn):
+    # the factual responses up to the first 'y', the counterfactual response and the explanation
+
+    # find the first 'y' in the list of responses
+    for i, response in enumerate(responses):
+        if response == 'y':
+            loc_prompt = i
+            break
+    cf_responses = responses[:loc_prompt+1]
+    cf_responses.append(yn+'cf')
+    cf_responses.append(responses[-1])
+
+    return cf_responses
+
 @click.command()
 @click.option('--factual_responses_file', required=True, help='File containing responses from the factual episode')
 @click.option('--yn', required=True, help='counterfactual response is y or n')
@@ -142,14 +166,7 @@ def cf_decision_responses(factual_responses_file, yn, cf_responses_file):
     with open(factual_responses_file, 'rb') as f:
         responses = pickle.load(f)
 
-    # find the first 'y' in the list of responses
-    for i, response in enumerate(responses):
-        if response == 'y':
-            loc_prompt = i
-            break
-    cf_responses = responses[:loc_prompt+1]
-    cf_responses.append(yn+'cf')
-    cf_responses.append(responses[-1])
+    cf_responses = counterfactual_responses(responses, yn)
 
     # write the responses
     with open(cf_responses_file, 'wb') as f: